@@ -0,0 +1,51 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+#!/usr/bin/python
+from distil.api import web
+from distil import config
+from distil.scheduler import Scheduler
+from datetime import timedelta
+import yaml
+import sys
+import signal
+
+import argparse
+a = argparse.ArgumentParser("Usage collection scheduler for Distil")
+
+a.add_argument("-c", "--config", dest="config", help="Path to config file", default="/etc/distil/conf.yaml")
+
+args = a.parse_args()
+
+conf = None
+
+try:
+    with open(args.config) as f:
+        conf = yaml.load(f)
+except IOError as e:
+    print "Couldn't load config file: %s" % e
+    sys.exit(1)
+
+# sets up config, the database and logging, as for the web service.
+web.get_app(conf)
+
+settings = config.collection.get('scheduler', {})
+scheduler = Scheduler(
+    settings.get('concurrency', config.collection.get('concurrency', 1)),
+    timedelta(minutes=settings.get('settle_minutes', 5)))
+
+signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: scheduler.stop())
+
+scheduler.run()
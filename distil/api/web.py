@@ -17,17 +17,30 @@ from flask import Flask, Blueprint
 from distil import database, config
 from distil.constants import iso_time, iso_date, dawn_of_time
 from distil.transformers import active_transformers as transformers
+from distil.transformers import NeedsSamples
 from distil.rates import RatesFile
 from distil.models import SalesOrder, _Last_Run
 from distil.helpers import convert_to, reset_cache
-from distil.interface import Interface, timed
+from distil.interface import Interface, FleetUsage, timed, setup_projection
+from distil.interface import transport_stats, setup_concurrency_limiter
+from distil.interface import concurrency_limits
+from distil.archive import setup_archive
+from distil import transform_pool
+from distil.pipeline import Pipeline
 from sqlalchemy import create_engine, func
 from sqlalchemy.orm import scoped_session, create_session
 from sqlalchemy.pool import NullPool
 from sqlalchemy.exc import IntegrityError, OperationalError
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
+from collections import deque, defaultdict
 from decimal import Decimal
 import json
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
 import logging as log
 from keystoneclient.middleware.auth_token import AuthProtocol as KeystoneMiddleware
 
@@ -41,6 +54,9 @@ Session = None
 
 app = Blueprint("main", __name__)
 
+# per worker thread state for concurrent usage collection.
+_worker = threading.local()
+
 DEFAULT_TIMEZONE = "Pacific/Auckland"
 
 
@@ -50,6 +66,12 @@ def get_app(conf):
 
     config.setup_config(conf)
 
+    check_meter_windows()
+    setup_projection()
+    setup_archive()
+    setup_concurrency_limiter()
+    transform_pool.setup_transform_pool()
+
     global engine
     engine = create_engine(config.main["database_uri"], poolclass=NullPool)
 
@@ -98,58 +120,385 @@ def get_last_collected():
     return 200, {'last_collected': str(last_collected)}
 
 
+window_size = timedelta(hours=1)
+
+# how long a resource's transformer state is carried over without any
+# new entries for it, before it's assumed gone.
+carry_over_limit = timedelta(days=1)
+
+
 def generate_windows(start, end):
     """Generator for 1 hour windows in a given range."""
-    window_size = timedelta(hours=1)
     while start + window_size <= end:
         window_end = start + window_size
         yield start, window_end
         start = window_end
 
 
+utc_epoch = datetime(1970, 1, 1)
+
+
+def meter_window(meter_info):
+    """The width of the windows a meter is collected in: an hour, or as
+       set by its window, in hours or days (e.g. 6h or 1d). Windows must
+       divide a day exactly, so that none crosses UTC midnight and falls
+       out of the sales orders either side of it."""
+    window = str(meter_info.get('window', 1))
+    units = {'h': 'hours', 'd': 'days'}
+    if window[-1] in units:
+        width = timedelta(**{units[window[-1]]: int(window[:-1])})
+    else:
+        width = timedelta(hours=int(window))
+
+    day = timedelta(days=1).total_seconds()
+    if not 0 < width.total_seconds() <= day or \
+            day % width.total_seconds():
+        raise ValueError("meter window %s doesn't divide a day" % window)
+    return width
+
+
+def check_meter_windows():
+    """Rejects configured meter windows that don't divide a day."""
+    for meter_name, meter_info in \
+            config.collection.get('meter_mappings', {}).items():
+        try:
+            meter_window(meter_info)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (meter_name, e))
+
+
+def window_closes(span, meter_info, start, end):
+    """Whether a meter's window, open since start, closes at end. Windows
+       close on the UTC boundaries of their width, or when adaptive, as
+       soon as any resource's volume changes within them."""
+    width = meter_window(meter_info).total_seconds()
+    if (end - utc_epoch).total_seconds() % width == 0:
+        return True
+    return (meter_info.get('adaptive_window', False) and
+            window_changed(span, meter_info, start, end))
+
+
+def window_changed(span, meter_info, start, end):
+    """Whether any resource's volume changed within the given range."""
+    if uses_statistics(meter_info):
+        return any(stats['min'] != stats['max']
+                   for stats in span.window(start, end))
+
+    volumes = {}
+    for entry in span.window(start, end):
+        volume = volumes.setdefault(entry['resource_id'],
+                                    entry['counter_volume'])
+        if volume != entry['counter_volume']:
+            return True
+    return False
+
+
 def filter_and_group(usage, usage_by_resource):
+    """Groups usage by resource, dropping untrusted samples.
+       Returns a count of the dropped samples by source."""
     with timed("filter and group by resource"):
         trust_sources = set(config.main.get('trust_sources', []))
+        untrusted = {}
         for u in usage:
             # the user can make their own samples, including those
             # that would collide with what we care about for
             # billing.
             # if we have a list of trust sources configured, then
             # discard everything not matching.
+            # where possible this is already done by the query.
             if trust_sources and u['source'] not in trust_sources:
-                log.warning('ignoring untrusted usage sample ' +
-                            'from source `%s`' % u['source'])
+                untrusted[u['source']] = untrusted.get(u['source'], 0) + 1
                 continue
 
             resource_id = u['resource_id']
             entries = usage_by_resource.setdefault(resource_id, [])
             entries.append(u)
+        return untrusted
 
 
 def transform_and_insert(tenant, usage_by_resource, transformer, service,
                          meter_info, window_start, window_end,
-                         db, timestamp):
+                         db, timestamp, carried):
+    """Transforms and inserts the usage of each resource in a window,
+       starting from the state carried over from the previous window.
+       Returns the states to carry over into the next."""
+    states = {}
     with timed("apply transformer + insert"):
+        usage_by_resource = dict(
+            (res, [carried[res]] + entries if res in carried else entries)
+            for res, entries in usage_by_resource.items())
+
+        # large windows can be transformed across worker processes.
+        pool = transform_pool.transform_pool
+        if pool is not None and pool.handles(transformer, usage_by_resource):
+            pooled = pool.transform(service, usage_by_resource,
+                                    window_start, window_end)
+        else:
+            pooled = None
+
         for res, entries in usage_by_resource.items():
             # apply the transformer.
-            transformed = transformer.transform_usage(
-                service, entries, window_start, window_end)
+            if pooled is not None:
+                transformed = pooled[res]
+            else:
+                transformed = transformer.transform_usage(
+                    service, entries, window_start, window_end)
+
+            state = transformer.carry_over(entries, window_start,
+                                           window_end)
+            if state is not None:
+                states[res] = state
+
+            if transformed:
+                insert_transformed(tenant, res, transformed, entries[-1],
+                                   meter_info, window_start, window_end,
+                                   db, timestamp)
+    return states
+
+
+def transform_statistics_and_insert(tenant, statistics, transformer, service,
+                                    meter_name, meter_info, window_start,
+                                    window_end, db, timestamp):
+    # the metadata comes from the resource's most recent sample, fetched
+    # only once per run, and only if the meter or transformer reads any.
+    needs_metadata = bool(meter_info['metadata'] or
+                          transformer.required_metadata())
+
+    with timed("apply statistics transformer + insert"):
+        for stats in statistics:
+            res = stats['groupby']['resource_id']
+
+            entry = None
+            if needs_metadata:
+                entry = tenant.last_sample(meter_name, res, window_end)
+            entry = entry or {'resource_metadata': {}}
+
+            try:
+                transformed = transformer.transform_statistics(
+                    service, stats, entry, window_start, window_end)
+            except NeedsSamples:
+                entries = tenant.usage(meter_name, window_start, window_end,
+                                       resource_id=res)
+                transformed = transformer.transform_usage(
+                    service, entries, window_start, window_end)
 
             if transformed:
-                res = meter_info.get('res_id_template', '%s') % res
+                insert_transformed(tenant, res, transformed, entry,
+                                   meter_info, window_start, window_end,
+                                   db, timestamp)
+
+
+def insert_transformed(tenant, res, transformed, entry, meter_info,
+                       window_start, window_end, db, timestamp):
+    res = meter_info.get('res_id_template', '%s') % res
+
+    md_def = meter_info['metadata']
+
+    db.insert_resource(tenant.id, res, meter_info['type'],
+                       timestamp, entry, md_def)
+    db.insert_usage(tenant.id, res, transformed,
+                    meter_info['unit'], window_start,
+                    window_end, timestamp)
+
+
+def uses_statistics(meter_info):
+    """Whether to use ceilometer's statistics for a meter, rather than its
+       samples. Only safe when untrusted sources are filtered by the query,
+       as statistics can't be filtered afterwards."""
+    return (meter_info.get('statistics', False) and
+            len(config.main.get('trust_sources', [])) <= 1)
+
+
+def backfill_settings():
+    return config.collection.get('backfill', {})
+
+
+def should_backfill(start, end):
+    """Whether a tenant last collected at start is far enough behind
+       to be backfilled."""
+    lag_hours = backfill_settings().get('lag_hours')
+    return bool(lag_hours) and end - start > timedelta(hours=lag_hours)
+
+
+def fetch_range(start, last, end, backfill=False, floor=None):
+    """The range of usage to fetch in one request, for windows from the
+       given start. Fleet-wide fetches are aligned to a common grid ending
+       at the end of the run, so that every tenant shares them, and
+       reach back no further than the floor, where the run's earliest
+       tenant starts. Backfills fetch for their own tenant only, over much
+       larger ranges."""
+    if backfill:
+        size = timedelta(
+            hours=backfill_settings().get('hours_per_fetch', 168))
+        return start, min(start + size, last)
+
+    size = timedelta(hours=config.collection.get('windows_per_fetch', 24))
 
-                md_def = meter_info['metadata']
+    if config.collection.get('fleet_fetch'):
+        cells = -(-(end - start).total_seconds() // size.total_seconds())
+        cell_start = end - timedelta(seconds=cells * size.total_seconds())
+        if floor is not None:
+            return max(cell_start, floor), cell_start + size
+        return cell_start, cell_start + size
 
-                db.insert_resource(tenant.id, res, meter_info['type'],
-                                   timestamp, entries[-1], md_def)
-                db.insert_usage(tenant.id, res, transformed,
-                                meter_info['unit'], window_start,
-                                window_end, timestamp)
+    return start, min(start + size, last)
 
 
-def collect_usage(tenant, db, session, resp, end):
+def fetch_spans(tenant, start, end, mappings, starts=None):
+    """Fetches usage for the given mapped meters across the given range,
+       with one request per meter, issued concurrently if configured.
+       Meters read from samples can instead share a single request.
+       Meters with open windows are fetched from the given starts."""
+    concurrency = config.collection.get('meter_concurrency', 1)
+    starts = starts or {}
+
+    stats_meters = [meter_name for meter_name, meter_info in mappings.items()
+                    if uses_statistics(meter_info)]
+    sample_meters = [meter_name for meter_name in mappings
+                     if meter_name not in stats_meters]
+
+    # fleet fetches already share requests across tenants.
+    if config.collection.get('batch_meters') and tenant.fleet is None:
+        jobs = [[meter_name] for meter_name in stats_meters]
+        if sample_meters:
+            jobs.append(sample_meters)
+    else:
+        jobs = [[meter_name] for meter_name in mappings]
+
+    def fetch(meter_names):
+        fetch_start = min([start] + [starts[m] for m in meter_names
+                                     if m in starts])
+        if meter_names[0] in stats_meters:
+            return {meter_names[0]: tenant.statistics_span(
+                meter_names[0], fetch_start, end,
+                window_size.total_seconds())}
+        if len(meter_names) > 1:
+            return tenant.batch_usage_spans(meter_names, fetch_start, end)
+        return {meter_names[0]: tenant.usage_span(meter_names[0],
+                                                  fetch_start, end)}
+
+    if concurrency > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(concurrency, len(jobs)))
+        try:
+            results = pool.map(fetch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch(meter_names) for meter_names in jobs]
+
+    spans = {}
+    for result in results:
+        spans.update(result)
+    return spans
+
+
+def collect_meter(tenant, span, meter_name, meter_info, window_start,
+                  window_end, db, timestamp, carried):
+    """Transforms and inserts the usage of a meter in a window,
+       from the meter's fetched span and the states carried over from
+       the previous window. Returns the states for the next. Windows
+       wider than an hour are transformed an hour at a time, and their
+       usage totalled, so that resources are only billed for the hours
+       they were around."""
+    if window_end - window_start > window_size:
+        totals = database.WindowTotals()
+        carried = dict(carried)
+        for start, end in generate_windows(window_start, window_end):
+            carried.update(collect_meter(tenant, span, meter_name,
+                                         meter_info, start, end, totals,
+                                         timestamp, carried))
+        totals.replay(db, window_start, window_end, timestamp)
+        return carried
+
+    transformer = transformers[meter_info['transformer']]()
+
+    if 'service' in meter_info:
+        service = meter_info['service']
+    else:
+        service = meter_name
+
+    if uses_statistics(meter_info):
+        transform_statistics_and_insert(tenant,
+                                        span.window(window_start, window_end),
+                                        transformer, service, meter_name,
+                                        meter_info, window_start, window_end,
+                                        db, timestamp)
+        return {}
+
+    usage_by_resource = {}
+    untrusted = filter_and_group(span.window(window_start, window_end),
+                                 usage_by_resource)
+    if untrusted:
+        log.warning('ignored %d untrusted usage samples '
+                    'for %s %s meter %s in window %s - %s '
+                    'from sources: %s' %
+                    (sum(untrusted.values()), tenant.id, tenant.name,
+                     meter_name, window_start, window_end,
+                     ', '.join(sorted(untrusted))))
+
+    return transform_and_insert(tenant, usage_by_resource, transformer,
+                                service, meter_info, window_start,
+                                window_end, db, timestamp, carried)
+
+
+def batch_windows(windows, end, backfill):
+    """Groups windows to be written in one transaction: each window on
+       its own, or when backfilling, all those fetched together."""
+    if not backfill:
+        return [[window] for window in windows]
+
+    batches = []
+    for window in windows:
+        if not batches or window[1] > batch_end:
+            batch_end = fetch_range(window[0], windows[-1][1], end,
+                                    backfill)[1]
+            batches.append([])
+        batches[-1].append(window)
+    return batches
+
+
+def fetch_ranges(batches, last, end, backfill, floor=None):
+    """Groups batches of windows by the range of usage fetched for them,
+       as (start, end, batches)."""
+    ranges = []
+    for batch in batches:
+        if not ranges or batch[-1][1] > ranges[-1][1]:
+            ranges.append(fetch_range(batch[0][0], last, end, backfill,
+                                      floor) + ([],))
+        ranges[-1][2].append(batch)
+    return ranges
+
+
+def meter_fetch_starts(mappings, start, opened):
+    """Where to fetch meters with wider windows from, for a range from
+       the given start: as early as their window open at the start could
+       have opened, which is no earlier than their last UTC boundary,
+       unless it's a window opened before the meter's width changed."""
+    starts = {}
+    for meter_name, meter_info in mappings.items():
+        width = meter_window(meter_info).total_seconds()
+        if width <= window_size.total_seconds():
+            continue
+        offset = (start - utc_epoch).total_seconds() % width
+        starts[meter_name] = start - timedelta(seconds=offset)
+        if meter_name in opened:
+            starts[meter_name] = min(starts[meter_name], opened[meter_name])
+    return starts
+
+
+def copy_states(states):
+    return dict((meter_name, dict(carried))
+                for meter_name, carried in states.items())
+
+
+def collect_usage(tenant, db, session, resp, end, backfill=False,
+                  max_windows=None, deadline=None):
     """Collects usage for a given tenant from when they were last collected,
-       up to the given end, and breaks the range into one hour windows."""
+       up to the given end, and breaks the range into one hour windows.
+       Tenants far enough behind are backfilled, without a limit on the
+       windows collected, and written in bulk. Given a deadline, no more
+       is written once it has passed."""
     run_once = False
     timestamp = datetime.utcnow()
     session.begin(subtransactions=True)
@@ -160,74 +509,488 @@ def collect_usage(tenant, db, session, resp, end):
                                  tenant.description, timestamp)
     start = db_tenant.last_collected
     session.commit()
-
-    max_windows = config.collection.get('max_windows_per_cycle', 0)
-    windows = generate_windows(start, end)
-
-    if max_windows:
-        windows = list(windows)[:max_windows]
-
-    for window_start, window_end in windows:
+    tenant.last_collected = start
+
+    if max_windows is None:
+        max_windows = config.collection.get('max_windows_per_cycle', 0)
+    windows = all_windows = list(generate_windows(start, end))
+
+    backfill = backfill or should_backfill(start, end)
+    tenant.backfill = backfill
+
+    if backfill:
+        log.info('backfilling %s %s from %s' % (tenant.id, tenant.name,
+                                                start))
+        db = database.BulkDatabase(session)
+    elif max_windows:
+        windows = windows[:max_windows]
+
+    if not windows:
+        return run_once
+
+    # transformer state carried from one window to the next, and between
+    # runs, so that each window is fetched without any lead-in.
+    states = db.carried_states(tenant.id, start)
+
+    # where the windows of meters collected in wider windows opened.
+    opened = db.open_windows(tenant.id)
+
+    mappings = config.collection['meter_mappings']
+
+    # skip the meters this tenant has no resources for, if we know.
+    active = tenant.conn.active
+    if active is not None:
+        meters = active.meters(tenant.id)
+        # meters with open windows are kept, so that they still close.
+        mappings = dict((meter_name, meter_info) for meter_name, meter_info
+                        in mappings.items()
+                        if meter_name in meters or meter_name in opened)
+
+        if not mappings:
+            # the listing covers the whole run, so there's nothing to
+            # collect all the way to its end, however far behind.
+            skip_to = all_windows[-1][1]
+            log.info('no usage for %s %s, skipping to %s' %
+                     (tenant.id, tenant.name, skip_to))
+            with session.begin(subtransactions=True):
+                db_tenant.last_collected = skip_to
+                session.add(db_tenant)
+            tenant.last_collected = skip_to
+            resp["tenants"].append(
+                {"id": tenant.id,
+                 "updated": True,
+                 "start": windows[0][0].strftime(iso_time),
+                 "end": skip_to.strftime(iso_time)
+                 }
+            )
+            return True
+
+    # usage is fetched for several windows at once, and sliced up per
+    # window in memory. Fetching, transforming and writing run as stages
+    # of a pipeline, so that the next windows are fetched and transformed
+    # while these are written. The transform stage carries states ahead
+    # of what has been written, and hands on a copy with each batch.
+    fleet = tenant.fleet
+    ranges = fetch_ranges(batch_windows(windows, end, backfill),
+                          windows[-1][1], end, backfill,
+                          fleet.floor if fleet is not None else None)
+    fetch_starts = dict(opened)
+    running_states = copy_states(states)
+    running_opened = dict(opened)
+
+    def fetch(fetched):
+        spans_start, spans_end, batches = fetched
+        spans = fetch_spans(tenant, spans_start, spans_end, mappings,
+                            meter_fetch_starts(mappings, spans_start,
+                                               fetch_starts))
+        return [(batch, spans) for batch in batches]
+
+    def transform(item):
+        batch, spans = item
+        writes = database.DeferredWrites()
+        for window_start, window_end in batch:
+            log.info("%s %s slice %s %s" % (tenant.id, tenant.name,
+                                            window_start, window_end))
+
+            for meter_name, meter_info in mappings.items():
+                meter_start = running_opened.setdefault(meter_name,
+                                                        window_start)
+                if not window_closes(spans[meter_name], meter_info,
+                                     meter_start, window_end):
+                    continue
+                del running_opened[meter_name]
+
+                carried = running_states.setdefault(meter_name, {})
+                carried.update(collect_meter(
+                    tenant, spans[meter_name], meter_name, meter_info,
+                    meter_start, window_end, writes, timestamp, carried))
+
+        return [(batch, writes, copy_states(running_states),
+                 dict(running_opened))]
+
+    pipe = Pipeline(ranges, [('fetch', fetch), ('transform', transform)],
+                    config.collection.get('pipeline_depth', 2))
+    finished = False
+    try:
+        for batch, writes, batch_states, batch_opened in pipe:
+            batch_start, batch_end = batch[0][0], batch[-1][1]
+            log.info("%s %s pipeline queues: %s" %
+                     (tenant.id, tenant.name,
+                      ', '.join('%s %d' % depth for depth
+                                in sorted(pipe.depths().items()))))
+            try:
+                with session.begin(subtransactions=True):
+                    writes.replay(db)
+                    db.flush()
+                    if opened or batch_opened:
+                        db.save_open_windows(tenant.id, batch_opened)
+                    # the carried states are saved along with how far we
+                    # got, so that they never fall out of step.
+                    for carried in batch_states.values():
+                        for res, state in carried.items():
+                            if state['timestamp'] < \
+                                    batch_end - carry_over_limit:
+                                del carried[res]
+                    db.save_carried_states(tenant.id, batch_states,
+                                           batch_end)
+                    db_tenant.last_collected = batch_end
+                    session.add(db_tenant)
+                db.keep_resources(tenant.id)
+
+                opened = batch_opened
+                tenant.last_collected = batch_end
+
+                resp["tenants"].append(
+                    {"id": tenant.id,
+                     "updated": True,
+                     "start": batch_start.strftime(iso_time),
+                     "end": batch_end.strftime(iso_time)
+                     }
+                )
+                run_once = True
+            except (IntegrityError, OperationalError):
+                # this is fine.
+                session.rollback()
+                db.discard_resources(tenant.id)
+                resp["tenants"].append(
+                    {"id": tenant.id,
+                     "updated": False,
+                     "error": "Integrity error",
+                     "start": batch_start.strftime(iso_time),
+                     "end": batch_end.strftime(iso_time)
+                     }
+                )
+                resp["errors"] += 1
+                log.warning("IntegrityError for %s %s in window: %s - %s " %
+                            (tenant.name, tenant.id,
+                             batch_start.strftime(iso_time),
+                             batch_end.strftime(iso_time)))
+                break
+
+            if deadline is not None and datetime.utcnow() >= deadline:
+                log.info("%s %s out of time at %s" %
+                         (tenant.id, tenant.name, batch_end))
+                break
+        finished = True
+    finally:
+        pipe.stop()
+        # metadata is only merged and written once, from the latest
+        # entries of the batches committed, even if we were cut short.
         try:
             with session.begin(subtransactions=True):
-                log.info("%s %s slice %s %s" % (tenant.id, tenant.name,
-                                                window_start, window_end))
+                db.sync_resource_metadata(tenant.id)
+        except Exception as e:
+            if finished:
+                raise
+            log.exception("%s %s: syncing resource metadata failed: %s" %
+                          (tenant.id, tenant.name, e))
+    return run_once
 
-                mappings = config.collection['meter_mappings']
 
-                for meter_name, meter_info in mappings.items():
-                    usage = tenant.usage(meter_name, window_start, window_end)
-                    usage_by_resource = {}
+def collector_name():
+    """A name for a collection run, unique across collector nodes, to
+       hold leases by."""
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                         uuid.uuid4().hex[:8])
 
-                    transformer = transformers[meter_info['transformer']]()
 
-                    filter_and_group(usage, usage_by_resource)
+def lease_holder():
+    """The name to hold tenant leases by, or None if they aren't used."""
+    if not config.collection.get('leases'):
+        return None
+    return collector_name()
 
-                    if 'service' in meter_info:
-                        service = meter_info['service']
-                    else:
-                        service = meter_name
 
-                    transform_and_insert(tenant, usage_by_resource,
-                                         transformer, service, meter_info,
-                                         window_start, window_end, db,
-                                         timestamp)
+@contextmanager
+def held_lease(db, name, holder, duration):
+    """Holds the named lease, if it can be claimed, renewing it in the
+       background until done. Yields whether it is held."""
+    if not db.claim_lease(name, holder, duration):
+        yield False
+        return
 
-                db_tenant.last_collected = window_end
-                session.add(db_tenant)
+    done = threading.Event()
 
-            resp["tenants"].append(
-                {"id": tenant.id,
-                 "updated": True,
-                 "start": window_start.strftime(iso_time),
-                 "end": window_end.strftime(iso_time)
-                 }
-            )
-            run_once = True
-        except (IntegrityError, OperationalError):
-            # this is fine.
-            session.rollback()
+    def renew():
+        session = Session()
+        try:
+            while not done.wait(duration.total_seconds() / 3):
+                if not database.Database(session).renew_lease(
+                        name, holder, duration):
+                    log.warning('lost the lease on %s' % name)
+                    return
+        finally:
+            session.close()
+
+    renewer = threading.Thread(target=renew)
+    renewer.daemon = True
+    renewer.start()
+    try:
+        yield True
+    finally:
+        done.set()
+        renewer.join()
+        try:
+            db.release_lease(name, holder)
+        except Exception as e:
+            # it'll expire anyway.
+            log.warning('releasing the lease on %s failed: %s' % (name, e))
+
+
+@contextmanager
+def tenant_lease(db, tenant, holder):
+    """Holds the tenant's lease while it's collected, when leases are
+       used. Yields whether it is held."""
+    if holder is None:
+        yield True
+        return
+
+    duration = timedelta(
+        seconds=config.collection['leases'].get('seconds', 300))
+    with held_lease(db, 'tenant:%s' % tenant.id, holder, duration) as held:
+        yield held
+
+
+def collect_leased(tenant, db, session, resp, end, holder, **kwargs):
+    """collect_usage, holding the tenant's lease when leases are used, so
+       that no other collector works on the tenant at the same time."""
+    with tenant_lease(db, tenant, holder) as leased:
+        if not leased:
+            log.info('%s %s is being collected elsewhere, skipping' %
+                     (tenant.id, tenant.name))
             resp["tenants"].append(
                 {"id": tenant.id,
                  "updated": False,
-                 "error": "Integrity error",
-                 "start": window_start.strftime(iso_time),
-                 "end": window_end.strftime(iso_time)
-                 }
-            )
-            resp["errors"] += 1
-            log.warning("IntegrityError for %s %s in window: %s - %s " %
-                        (tenant.name, tenant.id,
-                         window_start.strftime(iso_time),
-                         window_end.strftime(iso_time)))
-            return run_once
-    return run_once
+                 "skipped": "Collected elsewhere"})
+            return False
+        return collect_usage(tenant, db, session, resp, end, **kwargs)
+
+
+def collect_tenant_usage(tenant, end, fleet, active, backfill=False,
+                         max_windows=None, deadline=None, holder=None):
+    """Worker entry point for concurrent usage collection.
+       Each worker thread gets its own Interface (and so its own
+       requests.Session) and its own SQLAlchemy session, and collects
+       into its own response, to be merged by the caller."""
+    if getattr(_worker, 'interface', None) is None:
+        _worker.interface = Interface()
+    _worker.interface.fleet = fleet
+    _worker.interface.active = active
+    tenant.conn = _worker.interface
+
+    # Session is a scoped_session, so this is local to the worker thread.
+    session = Session()
+    db = database.Database(session)
+
+    resp = {"tenants": [], "errors": 0}
+    try:
+        run_once = collect_leased(tenant, db, session, resp, end, holder,
+                                  backfill=backfill, max_windows=max_windows,
+                                  deadline=deadline)
+    finally:
+        session.close()
+    return run_once, resp
 
 
 @app.route("collect_usage", methods=["POST"])
 @require_admin
 def run_usage_collection():
-    """Run usage collection on all tenants present in Keystone."""
+    """Run usage collection on all tenants present in Keystone.
+       -budget_seconds: optional, the time the run may take
+       -tenant_budget_seconds: optional, the time any one tenant may take"""
+    body = flask.request.get_json(silent=True) or {}
+    budget = dict(config.collection.get('budget', {}))
+    if 'budget_seconds' in body:
+        budget['cycle_seconds'] = body['budget_seconds']
+    if 'tenant_budget_seconds' in body:
+        budget['tenant_seconds'] = body['tenant_budget_seconds']
+
+    # a trigger while a run is going just reports on it, rather than
+    # duplicating its work.
+    session = Session()
+    try:
+        db = database.Database(session)
+        with run_lock(db) as held:
+            if held:
+                return collect_tenants(budget=budget)
+            return json.dumps(running_collection(db))
+    finally:
+        session.close()
+
+
+@contextmanager
+def run_lock(db):
+    """Holds the lock that lets only one collection run go at a time,
+       across all nodes. With tenant leases, runs already keep out of each
+       other's way, and nothing is locked. Yields whether it is held."""
+    if config.collection.get('leases'):
+        yield True
+        return
+
+    duration = timedelta(
+        seconds=config.collection.get('run_lock_seconds', 300))
+    with held_lease(db, 'collect_usage', collector_name(), duration) as held:
+        yield held
+
+
+def running_collection(db):
+    """What's known of the collection run in progress."""
+    lease = db.get_lease('collect_usage')
+    if lease is None:
+        # it finished since we looked.
+        return {"status": "already running"}
+    end = lease.acquired.replace(minute=0, second=0, microsecond=0)
+    return {"status": "already running",
+            "holder": lease.holder,
+            "started": lease.acquired.strftime(iso_time),
+            "progress": db.collection_progress(end)}
+
+
+@app.route("backfill", methods=["POST"])
+@require_admin
+@json_must("tenants")
+def run_backfill():
+    """Backfills usage for the given tenants now, however little they
+       lag behind.
+       -tenants: a list of tenant ids"""
+    session = Session()
+    try:
+        db = database.Database(session)
+        with run_lock(db) as held:
+            if held:
+                return collect_tenants(flask.request.json["tenants"],
+                                       backfill=True)
+            return json.dumps(running_collection(db))
+    finally:
+        session.close()
+
+
+def prepare_run(interface, db, tenants, end):
+    """Sets up what the tenants of a collection run up to end share."""
+    interface.fleet = None
+    interface.active = None
+    if config.collection.get('fleet_fetch'):
+        interface.fleet = FleetUsage(
+            config.collection.get('fleet_cache_samples', 1000000))
+        interface.fleet.floor = db.collection_start(t.id for t in tenants)
+
+    # one listing of resources up front tells us which tenants and
+    # meters have anything to collect.
+    if config.collection.get('skip_idle'):
+        start = db.collection_start(t.id for t in tenants)
+        if start is not None:
+            interface.active = interface.active_meters(start, end)
+
+
+def collect_within_budget(tenants, end, interface, budget, backfill=False,
+                          holder=None):
+    """Collects usage for the tenants round-robin, a turn of
+       windows_per_turn windows each, by default as many as are fetched
+       at once, until they're all caught up or the budget for the cycle
+       is spent. A tenant that has used up its own budget waits for the
+       next cycle. Returns whether any tenant was updated, and the merged
+       response."""
+    cycle_deadline = datetime.utcnow() + \
+        timedelta(seconds=budget['cycle_seconds'])
+    tenant_budget = timedelta(seconds=budget.get('tenant_seconds',
+                                                 budget['cycle_seconds']))
+    # a turn of less than a fetch would fetch and load state again for
+    # the rest of it on the next turn.
+    turn_windows = budget.get('windows_per_turn',
+                              config.collection.get('windows_per_fetch', 24))
+
+    resp = {"tenants": [], "errors": 0}
+    pending = deque(tenants)
+    spent = defaultdict(timedelta)
+    updated = []
+    taking_turns = [0]
+    condition = threading.Condition()
+
+    def take_turns():
+        while True:
+            with condition:
+                # a turn still going may put its tenant back.
+                while not pending and taking_turns[0]:
+                    condition.wait()
+                if not pending or datetime.utcnow() >= cycle_deadline:
+                    return
+                tenant = pending.popleft()
+                taking_turns[0] += 1
+
+            started = datetime.utcnow()
+            deadline = min(cycle_deadline,
+                           started + tenant_budget - spent[tenant.id])
+            try:
+                run_once, tenant_resp = collect_tenant_usage(
+                    tenant, end, interface.fleet, interface.active,
+                    backfill, turn_windows, deadline, holder)
+            except Exception as e:
+                run_once, tenant_resp = failed_tenant(tenant, e)
+
+            with condition:
+                taking_turns[0] -= 1
+                spent[tenant.id] += datetime.utcnow() - started
+                resp["tenants"].extend(tenant_resp["tenants"])
+                resp["errors"] += tenant_resp["errors"]
+                if run_once:
+                    updated.append(tenant.id)
+                    if (tenant.last_collected + window_size <= end and
+                            spent[tenant.id] < tenant_budget):
+                        pending.append(tenant)
+                condition.notify_all()
+
+    workers = [threading.Thread(target=take_turns) for _ in
+               range(max(1, config.collection.get('concurrency', 1)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return bool(updated), resp
+
+
+def concurrency_report(limits):
+    """The limiter's snapshot as reported by the API: the current limit,
+       and its last change with the reason for it."""
+    changes = [dict(change, time=change['time'].strftime(iso_time))
+               for change in limits['changes']]
+    return {"limit": limits['limit'],
+            "in_flight": limits['in_flight'],
+            "floor": limits['floor'],
+            "ceiling": limits['ceiling'],
+            "last_change": changes[-1] if changes else None}
+
+
+@app.route("concurrency", methods=["GET"])
+@returns_json
+@require_admin
+def get_concurrency():
+    """The adaptive limit on requests in flight to ceilometer, and its
+       recent changes with their reasons. Empty if it isn't adaptive."""
+    limits = concurrency_limits()
+    if limits is None:
+        return 200, {}
+    report = concurrency_report(limits)
+    report['changes'] = [dict(change, time=change['time'].strftime(iso_time))
+                         for change in limits['changes']]
+    return 200, report
+
+
+def failed_tenant(tenant, e):
+    """Logs a tenant whose collection raised, and returns the result to
+       report for it, so that the rest of the run carries on."""
+    log.exception('collecting %s %s failed: %s' %
+                  (tenant.id, tenant.name, e))
+    return False, {"tenants": [{"id": tenant.id,
+                                "updated": False,
+                                "failed": True,
+                                "error": str(e)}],
+                   "errors": 1}
+
+
+def collect_tenants(tenant_ids=None, backfill=False, budget=None):
+    """Collects usage for the given tenants, or all of them. Given a
+       budget, with cycle_seconds, the run is bounded in time instead of
+       by max_windows_per_cycle, and reports the tenants still behind."""
     try:
         log.info("Usage collection run started.")
 
@@ -237,32 +1000,91 @@ def run_usage_collection():
 
         reset_cache()
 
+        http_before = transport_stats.snapshot()
+
         db = database.Database(session)
 
         end = datetime.utcnow().\
             replace(minute=0, second=0, microsecond=0)
 
         tenants = interface.tenants
+        if tenant_ids is not None:
+            tenants = [t for t in tenants if t.id in tenant_ids]
+
+        prepare_run(interface, db, tenants, end)
 
         resp = {"tenants": [], "errors": 0}
         run_once = False
 
-        for tenant in tenants:
-            if collect_usage(tenant, db, session, resp, end):
-                run_once = True
-
-        if(run_once):
-            session.begin()
-            last_run = session.query(_Last_Run)
-            if last_run.count() == 0:
-                last_run = _Last_Run(last_run=end)
-                session.add(last_run)
-                session.commit()
-            else:
-                last_run[0].last_run = end
-                session.commit()
+        concurrency = config.collection.get('concurrency', 1)
+
+        # with leases, any number of collectors can run at once, each
+        # skipping the tenants another is working on.
+        holder = lease_holder()
+
+        if budget and budget.get('cycle_seconds'):
+            run_once, resp = collect_within_budget(tenants, end, interface,
+                                                   budget, backfill, holder)
+            last_collected = db.last_collected(t.id for t in tenants)
+            resp["behind"] = [
+                {"id": tenant_id, "last_collected": start.strftime(iso_time)}
+                for tenant_id, start in sorted(last_collected.items())
+                if start + window_size <= end]
+        elif concurrency > 1:
+            def collect(tenant):
+                try:
+                    return collect_tenant_usage(tenant, end, interface.fleet,
+                                                interface.active, backfill,
+                                                holder=holder)
+                except Exception as e:
+                    return failed_tenant(tenant, e)
+
+            pool = ThreadPool(concurrency)
+            try:
+                results = pool.imap_unordered(collect, tenants)
+                for tenant_run_once, tenant_resp in results:
+                    resp["tenants"].extend(tenant_resp["tenants"])
+                    resp["errors"] += tenant_resp["errors"]
+                    if tenant_run_once:
+                        run_once = True
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for tenant in tenants:
+                try:
+                    if collect_leased(tenant, db, session, resp, end, holder,
+                                      backfill=backfill):
+                        run_once = True
+                except Exception as e:
+                    session.rollback()
+                    tenant_resp = failed_tenant(tenant, e)[1]
+                    resp["tenants"].extend(tenant_resp["tenants"])
+                    resp["errors"] += tenant_resp["errors"]
+
+        # only a run across every tenant counts as the last run, and not
+        # one that some of them failed part way through.
+        partial = any(t.get("failed") for t in resp["tenants"])
+        if run_once and tenant_ids is None and not partial:
+            with session.begin():
+                db.update_last_run(end)
 
         session.close()
+
+        http = transport_stats.snapshot()
+        http = {k: v - http_before[k] for k, v in http.items()}
+        log.info("Ceilometer requests: %(requests)d, retries: %(retries)d, "
+                 "failures: %(failures)d, bytes: %(bytes)d, "
+                 "seconds: %(seconds).1f" % http)
+
+        limits = concurrency_limits()
+        if limits is not None:
+            log.info("Ceilometer concurrency limit: %d (%d to %d)" %
+                     (limits['limit'], limits['floor'], limits['ceiling']))
+            for change in limits['changes']:
+                log.info("  %(time)s -> %(limit)d: %(reason)s" % change)
+            resp["concurrency"] = concurrency_report(limits)
+
         log.info("Usage collection run complete.")
         return json.dumps(resp)
 
@@ -0,0 +1,268 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import json
+import mmap
+import zlib
+import bisect
+import threading
+import config
+from constants import iso_time
+from datetime import datetime, timedelta
+import logging as log
+
+# the archive in use, if one is configured. See setup_archive.
+sample_archive = None
+
+
+def setup_archive():
+    settings = config.collection.get('archive')
+
+    global sample_archive
+    if settings:
+        retention = settings.get('retention_days')
+        sample_archive = SampleArchive(
+            settings['path'],
+            settings.get('segment_size', 256 * 1024 * 1024),
+            timedelta(days=retention) if retention else None)
+    else:
+        sample_archive = None
+
+
+class RangeIndex(object):
+    """
+    The archived ranges of one tenant's meter, sorted by start, along
+    with the furthest end reached by any range up to each, so that a
+    covering range is found without scanning them all.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.entries = []
+        self.reach = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        """Adds an entry, (start, end, ...), replacing any archived
+           before for the same range."""
+        start, end = entry[0], entry[1]
+        i = bisect.bisect_left(self.starts, start)
+        j = i
+        while j < len(self.starts) and self.starts[j] == start:
+            if self.entries[j][1] == end:
+                self.entries[j] = entry
+                return
+            j += 1
+
+        self.starts.insert(i, start)
+        self.entries.insert(i, entry)
+        self.reach.insert(i, end)
+        self._reach_from(i)
+
+    def _reach_from(self, i):
+        for j in range(i, len(self.entries)):
+            end = self.entries[j][1]
+            self.reach[j] = max(end, self.reach[j - 1]) if j else end
+
+    def find(self, start, end):
+        """The entry of a range covering start to end, or None."""
+        j = bisect.bisect_right(self.starts, start) - 1
+        while j >= 0 and self.reach[j] >= end:
+            if self.entries[j][1] >= end:
+                return self.entries[j]
+            j -= 1
+        return None
+
+    def expire(self, cutoff):
+        """Drops the entries of ranges that ended before cutoff."""
+        entries = [entry for entry in self.entries if entry[1] >= cutoff]
+        if len(entries) != len(self.entries):
+            self.entries = entries
+            self.starts = [entry[0] for entry in entries]
+            self.reach = [entry[1] for entry in entries]
+            self._reach_from(0)
+
+
+class SampleArchive(object):
+    """
+    A local, append-only archive of the samples fetched from ceilometer,
+    so that ranges already fetched can be reprocessed from disk.
+    Each fetched sample set is zlib compressed and appended to a segment
+    file, and located through an index which is kept in memory and
+    appended to on disk. Segments are read back memory-mapped.
+    Samples are archived by the variant of the query that fetched them,
+    so that they're only reused for queries shaped the same, and given a
+    retention, ranges older than it are dropped, along with the segments
+    that hold nothing newer.
+    """
+    index_name = 'index'
+    # how often to look for ranges past their retention, while archiving.
+    expire_interval = timedelta(hours=1)
+
+    def __init__(self, path, segment_size, retention=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.retention = retention
+        self.lock = threading.Lock()
+        # (tenant_id, meter_name, variant) -> RangeIndex of
+        #   (start, end, segment, offset, length, record)
+        self.index = {}
+        self.maps = {}
+        self.segment = 0
+        self.expired = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load_index()
+        if self.retention is not None:
+            with self.lock:
+                self._expire(datetime.utcnow())
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment-%08d' % segment)
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, self.index_name)
+        if not os.path.exists(index_path):
+            return
+
+        sizes = {}
+        with open(index_path, 'r+') as fh:
+            lines = fh.readlines()
+            if lines and not lines[-1].endswith('\n'):
+                # a line only partly written before a crash, which
+                # would otherwise run into the next record appended.
+                fh.truncate(fh.tell() - len(lines.pop()))
+
+        for line in lines:
+            record = json.loads(line)
+
+            segment = record['segment']
+            if segment not in sizes:
+                path = self._segment_path(segment)
+                sizes[segment] = os.path.getsize(path) \
+                    if os.path.exists(path) else 0
+            if record['offset'] + record['length'] > sizes[segment]:
+                # the data never made it to disk.
+                continue
+
+            self._add(record)
+            self.segment = max(self.segment, segment)
+
+        log.info('loaded sample archive index from %s' % self.path)
+
+    def _add(self, record):
+        key = (record['tenant_id'], record['meter_name'],
+               record.get('variant'))
+        self.index.setdefault(key, RangeIndex()).add((
+            datetime.strptime(record['start'], iso_time),
+            datetime.strptime(record['end'], iso_time),
+            record['segment'], record['offset'], record['length'],
+            record))
+
+    def _read(self, segment, offset, length):
+        archived = self.maps.get(segment)
+        if archived is None or len(archived) < offset + length:
+            # not mapped yet, or mapped before this record was appended.
+            with open(self._segment_path(segment), 'rb') as fh:
+                archived = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = archived
+        return archived[offset:offset + length]
+
+    def _expire(self, now):
+        """Drops the ranges past the retention, and the segments left
+           holding none, rewriting the index without them."""
+        self.expired = now
+        cutoff = now - self.retention
+        records = []
+        for key, ranges in self.index.items():
+            ranges.expire(cutoff)
+            if not ranges:
+                del self.index[key]
+            records.extend(entry[5] for entry in ranges.entries)
+
+        live = set(record['segment'] for record in records)
+        live.add(self.segment)
+        for name in os.listdir(self.path):
+            if not name.startswith('segment-'):
+                continue
+            segment = int(name[len('segment-'):])
+            if segment not in live:
+                archived = self.maps.pop(segment, None)
+                if archived is not None:
+                    archived.close()
+                os.remove(os.path.join(self.path, name))
+
+        # written aside and renamed over, so a crash leaves one or the
+        # other whole.
+        index_path = os.path.join(self.path, self.index_name)
+        with open(index_path + '.new', 'w') as fh:
+            for record in records:
+                fh.write(json.dumps(record) + '\n')
+        os.rename(index_path + '.new', index_path)
+
+    def get(self, tenant_id, meter_name, start, end, variant=None):
+        """
+        Finds archived samples covering the given range, fetched by a
+        query of the given variant, or None if not archived.
+        """
+        with self.lock:
+            ranges = self.index.get((tenant_id, meter_name, variant))
+            entry = ranges.find(start, end) if ranges is not None else None
+            if entry is None:
+                return None
+            data = self._read(*entry[2:5])
+
+        return json.loads(zlib.decompress(data))
+
+    def put(self, tenant_id, meter_name, start, end, samples, variant=None):
+        """Archives the samples fetched for the given range, by a query
+           of the given variant."""
+        data = zlib.compress(json.dumps(samples))
+
+        with self.lock:
+            path = self._segment_path(self.segment)
+            if (os.path.exists(path) and
+                    os.path.getsize(path) >= self.segment_size):
+                self.segment += 1
+                path = self._segment_path(self.segment)
+
+            with open(path, 'ab') as fh:
+                fh.seek(0, os.SEEK_END)
+                offset = fh.tell()
+                fh.write(data)
+
+            record = {'tenant_id': tenant_id,
+                      'meter_name': meter_name,
+                      'variant': variant,
+                      'start': start.strftime(iso_time),
+                      'end': end.strftime(iso_time),
+                      'segment': self.segment,
+                      'offset': offset,
+                      'length': len(data)}
+
+            # the index is written after the data, so it never points
+            # at a record that isn't there.
+            with open(os.path.join(self.path, self.index_name), 'a') as fh:
+                fh.write(json.dumps(record) + '\n')
+
+            self._add(record)
+
+            now = datetime.utcnow()
+            if (self.retention is not None and
+                    now - self.expired >= self.expire_interval):
+                self._expire(now)
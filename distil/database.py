@@ -12,10 +12,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_, bindparam
+from sqlalchemy.exc import IntegrityError
 from .models import Resource, UsageEntry, Tenant, SalesOrder, _Last_Run
-from distil.constants import dawn_of_time
-from datetime import timedelta
+from .models import CarriedState, OpenWindow, Lease
+from distil.constants import dawn_of_time, other_date_format
+from datetime import datetime, timedelta
+from collections import OrderedDict
 import json
 import config
 import logging as log
@@ -25,6 +28,66 @@ class Database(object):
 
     def __init__(self, session):
         self.session = session
+        # resource ids we know exist, and the latest entries for resource
+        # metadata that is yet to be written, by tenant.
+        self.known_resources = {}
+        self.pending_metadata = {}
+        # the same, as added since the last kept transaction; dropped if
+        # it is rolled back.
+        self.added_resources = {}
+        self.added_metadata = {}
+
+    def _new_tenant_start(self):
+        """Where collection starts for a tenant we haven't seen before:
+           from the beginning until a run has collected every tenant, and
+           after that where collection has got to, by the last run or the
+           furthest collected tenant, whichever is later. A last run that
+           has fallen behind shouldn't send new tenants back to
+           backfill."""
+        last_run = self.session.query(_Last_Run).first()
+        if last_run is None:
+            return dawn_of_time
+        start = last_run.last_run
+        furthest = self.session.query(func.max(Tenant.last_collected)).\
+            scalar()
+        if furthest is not None:
+            start = max(start, furthest)
+        # start an hour earlier to ensure no data is missed
+        return start - timedelta(hours=1)
+
+    def update_last_run(self, end):
+        """Records a run that collected every tenant up to end."""
+        last_run = self.session.query(_Last_Run).first()
+        if last_run is None:
+            self.session.add(_Last_Run(last_run=end))
+        else:
+            last_run.last_run = end
+
+    def last_collected(self, tenant_ids):
+        """Where each of the given tenants will next be collected from,
+           including those not yet inserted."""
+        tenant_ids = set(tenant_ids)
+        last_collected = dict(
+            (tenant_id, start) for tenant_id, start
+            in self.session.query(Tenant.id, Tenant.last_collected)
+            if tenant_id in tenant_ids)
+        missing = tenant_ids - set(last_collected)
+        if missing:
+            start = self._new_tenant_start()
+            last_collected.update((tenant_id, start) for tenant_id in missing)
+        return last_collected
+
+    def collection_start(self, tenant_ids):
+        """The earliest point any of the given tenants will next be
+           collected from, including those not yet inserted."""
+        starts = self.last_collected(tenant_ids).values()
+        return min(starts) if starts else None
+
+    def resource_counts(self):
+        """The number of resources known for each tenant."""
+        return dict(self.session.query(Resource.tenant_id,
+                                       func.count(Resource.id)).
+                    group_by(Resource.tenant_id))
 
     def insert_tenant(self, tenant_id, tenant_name, metadata, timestamp):
         """If a tenant exists does nothing,
@@ -33,13 +96,7 @@ class Database(object):
         query = self.session.query(Tenant).\
             filter(Tenant.id == tenant_id)
         if query.count() == 0:
-            last_run = self.session.query(_Last_Run)
-            if last_run.count() == 0:
-                start = dawn_of_time
-            else:
-                # start equals the last run, minus an hour
-                # to ensure no data is missed
-                start = last_run[0].last_run - timedelta(hours=1)
+            start = self._new_tenant_start()
             tenant = Tenant(id=tenant_id,
                             info=metadata,
                             name=tenant_name,
@@ -54,26 +111,198 @@ class Database(object):
 
     def insert_resource(self, tenant_id, resource_id, resource_type,
                         timestamp, entry, md_def):
-        """If a given resource does not exist, creates it,
-           otherwise merges the metadata with the new entry."""
+        """If a given resource does not exist, creates it. The metadata
+           is merged with the new entry by sync_resource_metadata, which
+           only needs the latest entry for each resource."""
+        known = self.known_resources.get(tenant_id)
+        if known is None:
+            known = self.known_resources[tenant_id] = set(
+                resource for resource, in self.session.query(Resource.id).
+                filter(Resource.tenant_id == tenant_id))
 
-        query = self.session.query(Resource).\
-            filter(Resource.id == resource_id,
-                   Resource.tenant_id == tenant_id)
-        if query.count() == 0:
+        if resource_id not in known:
             info = self.merge_resource_metadata({'type': resource_type},
                                                 entry, md_def)
-            self.session.add(Resource(
-                id=resource_id,
-                info=json.dumps(info),
-                tenant_id=tenant_id,
-                created=timestamp))
-            self.session.flush()           # can't assume deferred constraints.
-        else:
-            md_dict = json.loads(query[0].info)
-            md_dict = self.merge_resource_metadata(md_dict, entry,
-                                                   md_def)
-            query[0].info = json.dumps(md_dict)
+            self._add_resource(tenant_id, resource_id, json.dumps(info),
+                               timestamp)
+            known.add(resource_id)
+            self.added_resources.setdefault(tenant_id, set()).add(
+                resource_id)
+
+        # meters sharing a resource may pick out different metadata.
+        added = self.added_metadata.setdefault(tenant_id, {})
+        added.setdefault(resource_id, {})[tuple(sorted(md_def))] = \
+            (entry, md_def)
+
+    def _add_resource(self, tenant_id, resource_id, info, timestamp):
+        self.session.add(Resource(
+            id=resource_id,
+            info=info,
+            tenant_id=tenant_id,
+            created=timestamp))
+        self.session.flush()           # can't assume deferred constraints.
+
+    def flush(self):
+        """Writes out anything held back."""
+        self.session.flush()
+
+    def sync_resource_metadata(self, tenant_id, chunk_size=500):
+        """Merges the latest entries seen for a tenant's resources into
+           their metadata, reading and writing it in bulk."""
+        self.keep_resources(tenant_id)
+        pending = self.pending_metadata.pop(tenant_id, {})
+        resource_ids = pending.keys()
+        updates = []
+
+        for i in range(0, len(resource_ids), chunk_size):
+            query = self.session.query(Resource.id, Resource.info).\
+                filter(Resource.tenant_id == tenant_id,
+                       Resource.id.in_(resource_ids[i:i + chunk_size]))
+            for resource_id, info in query:
+                md_dict = json.loads(info)
+                for entry, md_def in pending[resource_id].values():
+                    md_dict = self.merge_resource_metadata(md_dict, entry,
+                                                           md_def)
+                md_info = json.dumps(md_dict)
+                if md_info != info:
+                    updates.append({'_id': resource_id, 'info': md_info})
+
+        if updates:
+            table = Resource.__table__
+            self.session.execute(
+                table.update().
+                where(and_(table.c.id == bindparam('_id'),
+                           table.c.tenant_id == tenant_id)).
+                values(info=bindparam('info')),
+                updates)
+
+    def keep_resources(self, tenant_id):
+        """Keeps the resources and metadata entries added for a tenant,
+           once the transaction that inserted them has been committed."""
+        self.added_resources.pop(tenant_id, None)
+        pending = self.pending_metadata.setdefault(tenant_id, {})
+        for resource_id, entries in \
+                self.added_metadata.pop(tenant_id, {}).items():
+            pending.setdefault(resource_id, {}).update(entries)
+
+    def discard_resources(self, tenant_id):
+        """Forgets the resources and metadata entries added for a tenant
+           since they were last kept, after the transaction that inserted
+           them has been rolled back."""
+        known = self.known_resources.get(tenant_id)
+        if known is not None:
+            known.difference_update(
+                self.added_resources.get(tenant_id, ()))
+        self.added_resources.pop(tenant_id, None)
+        self.added_metadata.pop(tenant_id, None)
+
+    def carried_states(self, tenant_id, as_of):
+        """The transformer states carried over for a tenant's resources,
+           by meter and resource. States carried to any point other than
+           as_of are out of step with collection, and ignored."""
+        states = {}
+        query = self.session.query(CarriedState).\
+            filter(CarriedState.tenant_id == tenant_id,
+                   CarriedState.as_of == as_of)
+        for row in query:
+            state = json.loads(row.state)
+            state['timestamp'] = datetime.strptime(state['timestamp'],
+                                                   other_date_format)
+            states.setdefault(row.meter_name, {})[row.resource_id] = state
+        return states
+
+    def save_carried_states(self, tenant_id, states, as_of):
+        """Replaces the transformer states carried over for a tenant's
+           resources, in one statement."""
+        self.session.query(CarriedState).\
+            filter(CarriedState.tenant_id == tenant_id).\
+            delete(synchronize_session=False)
+
+        rows = []
+        for meter_name, carried in states.items():
+            for resource_id, state in carried.items():
+                state = dict(state, timestamp=state['timestamp'].strftime(
+                    other_date_format))
+                rows.append({'tenant_id': tenant_id,
+                             'meter_name': meter_name,
+                             'resource_id': resource_id,
+                             'state': json.dumps(state),
+                             'as_of': as_of})
+        if rows:
+            self.session.execute(CarriedState.__table__.insert(), rows)
+
+    def open_windows(self, tenant_id):
+        """The start of each of a tenant's open meter windows, by meter."""
+        return dict(self.session.query(OpenWindow.meter_name,
+                                       OpenWindow.start).
+                    filter(OpenWindow.tenant_id == tenant_id))
+
+    def save_open_windows(self, tenant_id, opened):
+        """Replaces a tenant's open meter windows, in one statement."""
+        self.session.query(OpenWindow).\
+            filter(OpenWindow.tenant_id == tenant_id).\
+            delete(synchronize_session=False)
+
+        if opened:
+            self.session.execute(OpenWindow.__table__.insert(), [
+                {'tenant_id': tenant_id, 'meter_name': meter_name,
+                 'start': start} for meter_name, start in opened.items()])
+
+    def claim_lease(self, name, holder, duration):
+        """Claims the named lease for the holder, for the given duration,
+           if it's free, expired, or already theirs. Returns whether they
+           hold it."""
+        now = datetime.utcnow()
+        table = Lease.__table__
+        claimed = self.session.execute(
+            table.update().
+            where(and_(table.c.name == name,
+                       or_(table.c.holder == holder,
+                           table.c.expires < now))).
+            values(holder=holder, acquired=now, expires=now + duration))
+        if claimed.rowcount:
+            return True
+        insert = table.insert().values(name=name, holder=holder,
+                                       acquired=now, expires=now + duration)
+        try:
+            if self.session.transaction is not None:
+                # so that losing a race doesn't fail the whole transaction.
+                with self.session.begin_nested():
+                    self.session.execute(insert)
+            else:
+                self.session.execute(insert)
+        except IntegrityError:
+            # held by someone else, or they just beat us to it.
+            return False
+        return True
+
+    def renew_lease(self, name, holder, duration):
+        """Extends the holder's lease, returning False if it's been lost."""
+        table = Lease.__table__
+        renewed = self.session.execute(
+            table.update().
+            where(and_(table.c.name == name, table.c.holder == holder)).
+            values(expires=datetime.utcnow() + duration))
+        return renewed.rowcount > 0
+
+    def get_lease(self, name):
+        """The named lease, if anyone holds it."""
+        return self.session.query(Lease).\
+            filter(Lease.name == name).\
+            filter(Lease.expires >= datetime.utcnow()).\
+            first()
+
+    def collection_progress(self, end):
+        """How many tenants have been collected up to end, of them all."""
+        return {"tenants": self.session.query(Tenant).count(),
+                "collected": self.session.query(Tenant).
+                filter(Tenant.last_collected >= end).count()}
+
+    def release_lease(self, name, holder):
+        table = Lease.__table__
+        self.session.execute(
+            table.delete().
+            where(and_(table.c.name == name, table.c.holder == holder)))
 
     def insert_usage(self, tenant_id, resource_id, entries, unit,
                      start, end, timestamp):
@@ -144,3 +373,106 @@ class Database(object):
                     pass
 
         return md_dict
+
+
+class DeferredWrites(object):
+    """
+    Stands in for a Database while usage is transformed, recording the
+    resources and usage to insert, so that they can be written later by
+    the thread that owns the session.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def insert_resource(self, *args):
+        self.writes.append(('insert_resource', args))
+
+    def insert_usage(self, *args):
+        self.writes.append(('insert_usage', args))
+
+    def replay(self, db):
+        """Makes the recorded writes to the given Database, in order."""
+        for method, args in self.writes:
+            getattr(db, method)(*args)
+
+
+class WindowTotals(object):
+    """
+    Stands in for a Database while a wide window is transformed an hour
+    at a time, totalling each resource's usage over the hours, so that
+    it can be written as a single entry for the whole window.
+    """
+
+    def __init__(self):
+        self.resources = OrderedDict()
+        self.usage = {}
+
+    def insert_resource(self, tenant_id, resource_id, *args):
+        # only the latest entry matters for the metadata.
+        self.resources[resource_id] = (tenant_id, resource_id) + args
+
+    def insert_usage(self, tenant_id, resource_id, entries, unit,
+                     start, end, timestamp):
+        totals = self.usage.setdefault(resource_id, ({}, unit))[0]
+        for service, volume in entries.items():
+            totals[service] = totals.get(service, 0) + volume
+
+    def replay(self, db, start, end, timestamp):
+        """Writes each resource's totals to the given Database, as usage
+           for the window from start to end."""
+        for resource_id, args in self.resources.items():
+            db.insert_resource(*args)
+            if resource_id in self.usage:
+                totals, unit = self.usage[resource_id]
+                db.insert_usage(args[0], resource_id, totals, unit,
+                                start, end, timestamp)
+
+
+class BulkDatabase(Database):
+    """
+    A Database that holds on to new resources and usage until flushed,
+    then inserts each with a single statement. For backfills, which
+    write many windows in one transaction.
+    """
+
+    def __init__(self, session):
+        super(BulkDatabase, self).__init__(session)
+        self.resource_rows = []
+        self.usage_rows = []
+
+    def _add_resource(self, tenant_id, resource_id, info, timestamp):
+        self.resource_rows.append({'id': resource_id,
+                                   'info': info,
+                                   'tenant_id': tenant_id,
+                                   'created': timestamp})
+
+    def insert_usage(self, tenant_id, resource_id, entries, unit,
+                     start, end, timestamp):
+        """Holds on to all given entries, to be inserted when flushed."""
+        for service, volume in entries.items():
+            self.usage_rows.append({'service': service,
+                                    'volume': volume,
+                                    'unit': unit,
+                                    'resource_id': resource_id,
+                                    'tenant_id': tenant_id,
+                                    'start': start,
+                                    'end': end,
+                                    'created': timestamp})
+
+    def flush(self):
+        """Inserts the resources, then the usage, held back so far."""
+        # resources go first, for the usage's foreign key.
+        if self.resource_rows:
+            self.session.execute(Resource.__table__.insert(),
+                                 self.resource_rows)
+        if self.usage_rows:
+            self.session.execute(UsageEntry.__table__.insert(),
+                                 self.usage_rows)
+        self.resource_rows = []
+        self.usage_rows = []
+
+    def discard_resources(self, tenant_id):
+        super(BulkDatabase, self).discard_resources(tenant_id)
+        self.resource_rows = []
+        self.usage_rows = []
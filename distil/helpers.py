@@ -15,22 +15,33 @@
 from novaclient.v1_1 import client
 from cinderclient.v1 import client as cinderclient
 from decimal import Decimal
+import threading
 import config
 import math
 import logging as log
 
-cache = {}
+cache = {'flavors': {}, 'volume_types': []}
+cache_lock = threading.Lock()
 
 
 def reset_cache():
     global cache
     log.info("flavors/volume_types cache reset")
-    cache = {'flavors': {}, 'volume_types': []}
+    with cache_lock:
+        cache = {'flavors': {}, 'volume_types': []}
+
+
+def current_cache():
+    """The cache in use, which a lookup holds on to throughout, so that
+       it isn't thrown by the cache being reset in the meantime."""
+    with cache_lock:
+        return cache
 
 
 def flavor_name(f_id):
     """Grabs the correct flavor name from Nova given the correct ID."""
-    if f_id not in cache['flavors']:
+    flavors = current_cache()['flavors']
+    if f_id not in flavors:
         nova = client.Client(
             config.auth['username'],
             config.auth['password'],
@@ -38,12 +49,13 @@ def flavor_name(f_id):
             config.auth['end_point'],
             insecure=config.auth['insecure'])
 
-        cache['flavors'][f_id] = nova.flavors.get(f_id).name
-    return cache['flavors'][f_id]
+        flavors[f_id] = nova.flavors.get(f_id).name
+    return flavors[f_id]
 
 
 def volume_type(volume_type):
-    if not cache['volume_types']:
+    cached = current_cache()
+    if not cached['volume_types']:
         cinder = cinderclient.Client(
             config.auth['username'],
             config.auth['password'],
@@ -51,11 +63,11 @@ def volume_type(volume_type):
             config.auth['end_point'],
             insecure=config.auth['insecure'])
 
-        for vtype in cinder.volume_types.list():
-            cache['volume_types'].append({'id': vtype.id,
-                                          'name': vtype.name})
+        # filled in whole, so no one sees part of the list.
+        cached['volume_types'] = [{'id': vtype.id, 'name': vtype.name}
+                                  for vtype in cinder.volume_types.list()]
 
-    for vtype in cache['volume_types']:
+    for vtype in cached['volume_types']:
         # check name first, as that will be more common
         if vtype['name'] == volume_type:
             return volume_type
@@ -13,12 +13,24 @@
 #    under the License.
 
 import requests
+import requests.adapters
 import json
+import random
+import time
+import codecs
+import re
+import bisect
+import threading
 import auth
-from constants import date_format, other_date_format
+import archive
+from constants import date_format
 import config
+import transformers
 from datetime import timedelta, datetime
+from itertools import imap
 from contextlib import contextmanager
+from collections import OrderedDict, deque
+from operator import itemgetter
 import logging as log
 
 import urlparse
@@ -32,10 +44,296 @@ def timed(desc):
     log.debug("%s: %s" % (desc, end - start))
 
 
+class TransportStats(object):
+    """Counters for all the requests made to ceilometer by this process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'failures': 0,
+                         'bytes': 0, 'seconds': 0.0}
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                self.counters[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+transport_stats = TransportStats()
+
+# the limiter on requests in flight to ceilometer, if one is configured.
+# See setup_concurrency_limiter.
+concurrency_limiter = None
+
+
+def setup_concurrency_limiter():
+    settings = config.collection.get('adaptive_concurrency')
+
+    global concurrency_limiter
+    if settings:
+        default_ceiling = (config.collection.get('concurrency', 1) *
+                           config.collection.get('meter_concurrency', 1))
+        concurrency_limiter = ConcurrencyLimiter(
+            settings.get('floor', 1),
+            settings.get('ceiling', default_ceiling),
+            settings.get('latency_target', 10.0),
+            settings.get('decrease', 0.5))
+    else:
+        concurrency_limiter = None
+
+
+def concurrency_limits():
+    """The limiter's snapshot, or None when there is no limiter."""
+    limiter = concurrency_limiter
+    return limiter.snapshot() if limiter is not None else None
+
+
+class ConcurrencyLimiter(object):
+    """
+    Bounds the requests in flight to ceilometer, and moves the bound with
+    how ceilometer is coping (additive increase, multiplicative decrease).
+    The limit doubles each round of requests until the first sign of
+    trouble, then grows by one each round while responses come back
+    within the latency target. Errors, timeouts and slow responses cut it
+    by the decrease factor, at most once for the requests that were in
+    flight together, so one overload isn't counted many times over.
+    """
+
+    def __init__(self, floor, ceiling, latency_target, decrease=0.5,
+                 history=20):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.condition = threading.Condition()
+        self.limit = float(self.floor)
+        self.in_flight = 0
+        self.slow_start = True
+        # requests are numbered as sent, to tell which were in flight
+        # when the limit was last cut.
+        self.sent = 0
+        self.decreased_at = 0
+        self.changes = deque(maxlen=history)
+
+    def acquire(self):
+        """Waits for room under the limit, returning the slot taken."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.sent += 1
+            return LimiterSlot(self, self.sent)
+
+    def release(self, slot, error=None):
+        with self.condition:
+            self.in_flight -= 1
+            if error is not None:
+                if overloaded(error):
+                    self._decrease(slot, str(error) or type(error).__name__)
+            elif slot.latency > self.latency_target:
+                self._decrease(slot, 'response took %.1fs, over the %.1fs '
+                               'target' % (slot.latency, self.latency_target))
+            else:
+                step = 1.0 if self.slow_start else 1.0 / self.limit
+                self._set(min(self.ceiling, self.limit + step),
+                          'responses within the %.1fs target'
+                          % self.latency_target)
+            self.condition.notify_all()
+
+    def _decrease(self, slot, reason):
+        # requests sent before the last cut saw the load that caused it.
+        if slot.number <= self.decreased_at:
+            return
+        self.decreased_at = self.sent
+        self.slow_start = False
+        self._set(max(self.floor, self.limit * self.decrease), reason)
+
+    def _set(self, limit, reason):
+        before = int(self.limit)
+        self.limit = limit
+        if int(limit) != before:
+            self.changes.append({'time': datetime.utcnow(),
+                                 'limit': int(limit), 'reason': reason})
+            log.info('ceilometer concurrency %d -> %d: %s' %
+                     (before, int(limit), reason))
+
+    def snapshot(self):
+        """The current limit and the last changes to it, with reasons."""
+        with self.condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight,
+                    'floor': self.floor, 'ceiling': self.ceiling,
+                    'changes': list(self.changes)}
+
+
+class LimiterSlot(object):
+    """A request's place under the limit, timing its response."""
+    def __init__(self, limiter, number):
+        self.limiter = limiter
+        self.number = number
+        self.started = time.time()
+        self.latency = None
+
+    def responded(self):
+        # time to the response headers, which is how long ceilometer
+        # took over the query, whatever the size of the body.
+        self.latency = time.time() - self.started
+
+    def release(self, error=None):
+        self.limiter.release(self, error)
+
+
+class RetryableError(Exception):
+    pass
+
+
+def overloaded(error):
+    """
+    Whether a failed request says ceilometer is struggling, rather than
+    that the request was bad.
+    """
+    return isinstance(error, (RetryableError, TruncatedResponse,
+                              requests.exceptions.ConnectionError,
+                              requests.exceptions.ChunkedEncodingError,
+                              requests.exceptions.Timeout))
+
+
+class Transport(object):
+    """
+    HTTP transport for ceilometer, with a sized keep-alive connection pool,
+    gzip, connect/read timeouts, and jittered exponential retries on server
+    errors, timeouts and dropped connections.
+    """
+    def __init__(self, auth):
+        self.auth = auth
+        self.endpoint = None
+
+        settings = config.collection.get('http', {})
+        self.timeout = (settings.get('connect_timeout', 10),
+                        settings.get('read_timeout', 300))
+        self.retries = settings.get('retries', 3)
+        self.backoff = settings.get('backoff', 1.0)
+        self.max_backoff = settings.get('max_backoff', 60.0)
+
+        # a worker makes at most meter_concurrency requests at once.
+        pool_size = settings.get(
+            'pool_size', config.collection.get('meter_concurrency', 1))
+
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        # walking the service catalog is expensive, so only do it once.
+        if self.endpoint is None:
+            self.endpoint = self.auth.get_ceilometer_endpoint()
+        return urlparse.urljoin(self.endpoint, path)
+
+    def get(self, path, query, consume=list, retry_timeouts=True):
+        return self.request('GET', path, query, consume, retry_timeouts)
+
+    def post(self, path, body, consume=list, retry_timeouts=True):
+        return self.request('POST', path, body, consume, retry_timeouts)
+
+    def request(self, method, path, body, consume=list, retry_timeouts=True):
+        """
+        Makes a request to ceilometer with the given JSON body, passing the
+        JSON array response, decoded item by item as it arrives, to consume.
+        The whole exchange is retried if it fails, including a connection
+        dropped part way through the body. Read timeouts can instead be
+        raised straight away, for callers that would rather split the query.
+        """
+        for attempt in range(self.retries + 1):
+            started = time.time()
+            received = [0]
+
+            def chunks(r):
+                for chunk in r.iter_content(chunk_size=stream_chunk_size):
+                    received[0] += len(chunk)
+                    yield chunk
+
+            # the slot is held for the whole exchange, body and all, as
+            # ceilometer is still working until the last of it is sent.
+            limiter = concurrency_limiter
+            slot = limiter.acquire() if limiter is not None else None
+            r = None
+            try:
+                try:
+                    r = self.session.request(
+                        method,
+                        self.url(path),
+                        headers={
+                            "X-Auth-Token": self.auth.auth_token,
+                            "Content-Type": "application/json"
+                        },
+                        data=json.dumps(body),
+                        stream=True,
+                        timeout=self.timeout)
+                    if slot is not None:
+                        slot.responded()
+
+                    if r.status_code >= 500:
+                        raise RetryableError('%d %s' % (r.status_code,
+                                                        r.text))
+                    if r.status_code != 200:
+                        raise InterfaceException('%d %s' % (r.status_code,
+                                                            r.text))
+
+                    # decode items one at a time as the body arrives,
+                    # rather than holding the whole payload in memory.
+                    result = consume(iter_json_array(chunks(r)))
+                except Exception as e:
+                    # a body given up part way leaves the connection
+                    # unusable, so it's dropped rather than pooled.
+                    if r is not None:
+                        r.raw.close()
+                    # released before any backoff, so waiting to retry
+                    # doesn't hold a slot.
+                    if slot is not None:
+                        slot.release(e)
+                    raise
+                finally:
+                    if r is not None:
+                        r.close()
+                if slot is not None:
+                    slot.release()
+                return result
+            except (RetryableError, TruncatedResponse,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if (not retry_timeouts and
+                        isinstance(e, requests.exceptions.ReadTimeout)):
+                    raise QueryTimeout('%s timed out: %s' % (path, e))
+                if attempt == self.retries:
+                    transport_stats.add(failures=1)
+                    raise InterfaceException('%s failed after %d attempts: '
+                                             '%s' % (path, attempt + 1, e))
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                log.warning('retrying %s in %.1fs: %s' % (path, delay, e))
+                transport_stats.add(retries=1)
+                time.sleep(delay)
+            finally:
+                transport_stats.add(requests=1, bytes=received[0],
+                                    seconds=time.time() - started)
+
+
 class Interface(object):
     """Interface for talking to openstack components."""
     def __init__(self):
-        self.session = requests.Session()
+        # when set, a FleetUsage shared between all the tenants of a
+        # collection run, which fetches usage for all projects at once.
+        self.fleet = None
+        self.active = None
+
+        # strips samples down to what collection uses, as they arrive.
+        self.projection = Projection(projection_keys) \
+            if projection_keys is not None else None
 
         # This is the Keystone client connection, which provides our
         # OpenStack authentication
@@ -48,6 +346,8 @@ class Interface(object):
             region_name=config.main['region']
         )
 
+        self.transport = Transport(self.auth)
+
     @property
     def tenants(self):
         """All the tenants as known by keystone."""
@@ -73,11 +373,242 @@ class Interface(object):
 
         return tenants
 
+    def samples(self, meter_name, fields, limit=None, bounded=False):
+        """Queries ceilometer for the samples of a meter matching the
+           given fields, projected and sorted.
+           If bounded, responses over the configured size, or that time
+           out, raise ResponseTooLarge or QueryTimeout to be split up."""
+        query = {'q': fields}
+        max_samples = split_settings().get('max_samples') \
+            if bounded else None
+
+        if max_samples:
+            # ask for one more than we'll take, so we can tell if the
+            # response was cut short.
+            query['limit'] = max_samples + 1
+        elif limit is not None:
+            query['limit'] = limit
+
+        def consume(samples):
+            if max_samples:
+                samples = bound_items(samples, max_samples)
+            if self.projection is not None:
+                samples = imap(self.projection, samples)
+            return sort_entries(samples)
+
+        return self.transport.get('/v2/meters/%s' % meter_name, query,
+                                  consume, retry_timeouts=not bounded)
+
+    def usage(self, meter_name, start, end, project_id=None,
+              resource_id=None):
+        """Queries ceilometer for all the entries in a given range,
+           for a given meter, optionally limited to a single project
+           or resource."""
+        with timed('fetch global usage for meter %s' % meter_name):
+            if split_settings():
+                return self.split_usage(meter_name, start, end, project_id,
+                                        resource_id)
+            return self.samples(meter_name,
+                                usage_fields(start, end, project_id,
+                                             resource_id))
+
+    def split_usage(self, meter_name, start, end, project_id=None,
+                    resource_id=None):
+        """
+        Queries ceilometer for usage as in usage(), but splits the query
+        when the response is too large or times out: in half by time,
+        down to a minimum span, and then by resource, merging the results.
+        """
+        try:
+            return self.samples(meter_name,
+                                usage_fields(start, end, project_id,
+                                             resource_id),
+                                bounded=True)
+        except (ResponseTooLarge, QueryTimeout) as e:
+            settings = split_settings()
+            min_span = timedelta(minutes=settings.get('min_span_minutes', 5))
+
+            if end - start > min_span:
+                middle = start + timedelta(
+                    seconds=int((end - start).total_seconds() / 2))
+                log.info('splitting %s for %s at %s: %s' %
+                         (meter_name, project_id, middle, e))
+                # the halves don't overlap, so are already in order.
+                return (self.split_usage(meter_name, start, middle,
+                                         project_id, resource_id) +
+                        self.split_usage(meter_name, middle, end,
+                                         project_id, resource_id))
+
+            if project_id is not None and resource_id is None:
+                resources = [r['resource_id'] for r in
+                             self.resources(start, end, project_id)
+                             if meter_name in resource_meters(r)]
+                log.info('splitting %s for %s from %s by %d resources: %s' %
+                         (meter_name, project_id, start, len(resources), e))
+                usage = []
+                for resource in resources:
+                    usage.extend(self.samples(
+                        meter_name,
+                        usage_fields(start, end, project_id, resource)))
+                usage.sort(key=lambda x: x['timestamp'])
+                return usage
+
+            raise
+
+    def query_samples(self, meter_names, start, end, project_id):
+        """
+        Queries ceilometer for the entries of several meters in a given
+        range for a project in one request, through the complex query api,
+        returning them sorted and split up by meter.
+        """
+        expressions = [{'=': {'project_id': project_id}},
+                       {'>=': {'timestamp': start.strftime(date_format)}},
+                       {'<': {'timestamp': end.strftime(date_format)}},
+                       {'or': [{'=': {'counter_name': meter_name}}
+                               for meter_name in meter_names]}]
+        for field in add_trust_sources():
+            expressions.append({'=': {field['field']: field['value']}})
+
+        body = {'filter': json.dumps({'and': expressions}),
+                'orderby': json.dumps([{'timestamp': 'asc'}])}
+        max_samples = split_settings().get('max_samples')
+        if max_samples:
+            body['limit'] = max_samples + 1
+
+        def consume(samples):
+            samples = imap(complex_query_sample, samples)
+            if max_samples:
+                samples = bound_items(samples, max_samples)
+            if self.projection is not None:
+                samples = imap(self.projection, samples)
+            return sort_entries(samples)
+
+        with timed('fetch usage for %d meters' % len(meter_names)):
+            usage = self.transport.post('/v2/query/samples', body, consume,
+                                        retry_timeouts=not max_samples)
+
+        usage = partition_entries(usage, key=itemgetter('counter_name'))
+        return dict((meter_name, usage.get(meter_name, []))
+                    for meter_name in meter_names)
+
+    def resources(self, start, end, project_id=None):
+        """Queries ceilometer for the resources with samples in
+           the given range, optionally for a single project."""
+        fields = add_ids(project_id)
+        fields.extend(add_dates(start, end))
+        fields.extend(add_trust_sources())
+
+        with timed('fetch resources for %s' % project_id):
+            return self.transport.get('/v2/resources', {'q': fields})
+
+    def active_meters(self, start, end):
+        """The meters each project has samples for in the given range,
+           from one listing of resources across all projects."""
+        return ActiveMeters(self.resources(start, end))
+
+    def last_sample(self, meter_name, resource_id, end):
+        """The most recent sample for a resource before the given end."""
+        fields = add_ids(resource_id=resource_id)
+        fields.append({'field': 'timestamp', 'op': 'lt',
+                       'value': end.strftime(date_format)})
+        fields.extend(add_trust_sources())
+
+        with timed('fetch last sample for %s %s' % (meter_name, resource_id)):
+            samples = self.samples(meter_name, fields, limit=1)
+        return samples[-1] if samples else None
+
+    def statistics(self, meter_name, start, end, period, project_id=None):
+        """Queries ceilometer for per resource statistics of a meter in
+           a given range, in periods of the given number of seconds."""
+        fields = add_ids(project_id)
+        fields.extend(add_dates(start, end))
+        fields.extend(add_trust_sources())
+
+        groupby = ['resource_id']
+        if project_id is None:
+            groupby.append('project_id')
+
+        with timed('fetch statistics for meter %s' % meter_name):
+            statistics = self.transport.get(
+                '/v2/meters/%s/statistics' % meter_name,
+                {'q': fields, 'groupby': groupby, 'period': int(period)})
+
+        for row in statistics:
+            row['period_start'] = parse_timestamp(row['period_start'])
+        return statistics
+
 
 class InterfaceException(Exception):
     pass
 
-window_leadin = timedelta(minutes=10)
+
+class TruncatedResponse(InterfaceException):
+    pass
+
+
+class ResponseTooLarge(InterfaceException):
+    pass
+
+
+class QueryTimeout(InterfaceException):
+    pass
+
+# the resource_metadata keys kept on samples, see setup_projection.
+projection_keys = None
+
+stream_chunk_size = 64 * 1024
+
+_whitespace = u' \t\n\r'
+
+# the characters that delimit JSON values, and the rest of a string.
+_delimiters = re.compile(r'["{}\[\],\s]')
+_string_tail = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+
+def complex_query_sample(sample):
+    """Renames the fields of a sample from the complex query api to
+       match those of the meters api."""
+    sample['counter_name'] = sample.pop('meter')
+    sample['counter_volume'] = sample.pop('volume')
+    sample['resource_metadata'] = sample.pop('metadata', {})
+    return sample
+
+
+def split_settings():
+    """Settings for splitting up large queries, empty if disabled."""
+    return config.collection.get('split', {})
+
+
+def bound_items(items, max_items):
+    """Passes items through, raising ResponseTooLarge past max_items."""
+    for i, item in enumerate(items):
+        if i == max_items:
+            raise ResponseTooLarge('more than %d items' % max_items)
+        yield item
+
+
+def resource_meters(resource):
+    """The names of the meters a ceilometer resource has samples for."""
+    return set(link['rel'] for link in resource.get('links', [])
+               if link['rel'] != 'self')
+
+
+def usage_fields(start, end, project_id=None, resource_id=None):
+    fields = add_ids(project_id, resource_id)
+    fields.extend(add_dates(start, end))
+    fields.extend(add_trust_sources())
+    return fields
+
+
+def add_ids(project_id=None, resource_id=None):
+    fields = []
+    if project_id is not None:
+        fields.append({'field': 'project_id', 'op': 'eq',
+                       'value': project_id})
+    if resource_id is not None:
+        fields.append({'field': 'resource_id', 'op': 'eq',
+                       'value': resource_id})
+    return fields
 
 
 def add_dates(start, end):
@@ -95,19 +626,354 @@ def add_dates(start, end):
     ]
 
 
+def setup_projection():
+    """
+    Compiles the set of resource_metadata keys that collection actually
+    reads, from the meter mappings' metadata definitions and the keys
+    used by their transformers. Everything else is dropped at ingest.
+    """
+    keys = set()
+    for meter_info in config.collection.get('meter_mappings', {}).values():
+        for parameters in meter_info.get('metadata', {}).values():
+            keys.update(parameters['sources'])
+        transformer = transformers.active_transformers[
+            meter_info['transformer']]
+        keys.update(transformer.required_metadata())
+
+    global projection_keys
+    projection_keys = frozenset(keys)
+
+
+class Projection(object):
+    """
+    Strips a sample down to the fields collection uses, and to the
+    configured resource_metadata keys, interning the strings that repeat
+    across samples (ids, sources, and so on).
+    """
+    fields = ('counter_name', 'counter_volume', 'project_id',
+              'resource_id', 'source', 'timestamp')
+    interned = ('counter_name', 'project_id', 'resource_id', 'source')
+
+    def __init__(self, metadata_keys, max_strings=100000):
+        self.metadata_keys = metadata_keys
+        self.max_strings = max_strings
+        self.strings = {}
+
+    def intern(self, value):
+        # the builtin intern() only takes byte strings, not unicode.
+        if isinstance(value, basestring):
+            # long lived connections would otherwise keep every string
+            # they've ever seen; starting over only costs some sharing.
+            if len(self.strings) >= self.max_strings:
+                self.strings.clear()
+            return self.strings.setdefault(value, value)
+        return value
+
+    def __call__(self, sample):
+        projected = {}
+        for field in self.fields:
+            if field in sample:
+                projected[field] = sample[field]
+        for field in self.interned:
+            if field in projected:
+                projected[field] = self.intern(projected[field])
+
+        metadata = sample.get('resource_metadata') or {}
+        projected['resource_metadata'] = {
+            self.intern(key): self.intern(value)
+            for key, value in metadata.iteritems()
+            if key in self.metadata_keys}
+        return projected
+
+
+def add_trust_sources():
+    """
+    Constrains the query to the trusted sources, where the ceilometer
+    query language can express it. It only has equality, so only a
+    single trusted source can be pushed down; otherwise filtering
+    is left to the client.
+    """
+    trust_sources = config.main.get('trust_sources', [])
+    if len(trust_sources) == 1:
+        return [{'field': 'source', 'op': 'eq', 'value': trust_sources[0]}]
+    return []
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally decodes a JSON array from an iterable of byte chunks,
+    yielding each item as soon as it is complete.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+        while True:
+            while pos < len(buf) and buf[pos] in _whitespace:
+                pos += 1
+            if pos == len(buf):
+                break
+
+            if not started:
+                if buf[pos] != u'[':
+                    raise InterfaceException('expected a JSON array')
+                started = True
+                pos += 1
+            elif buf[pos] == u',':
+                pos += 1
+            elif buf[pos] == u']':
+                return
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError as e:
+                    if _value_end(buf, pos) is None:
+                        # the item isn't all here yet.
+                        break
+                    raise InterfaceException('malformed JSON array item: '
+                                             '%s' % e)
+                if end == len(buf) and buf[pos] not in u'"{[':
+                    # a number or literal may carry on in the next chunk.
+                    break
+                yield item
+                pos = end
+
+    raise TruncatedResponse('truncated JSON array')
+
+
+def _value_end(buf, pos):
+    """
+    Where the JSON value starting at pos ends, going by its brackets and
+    strings alone, or None if it runs past the end of the buffer.
+    """
+    depth = 0
+    match = _delimiters.search(buf, pos)
+    while match is not None:
+        i = match.start()
+        c = buf[i]
+        if c == u'"':
+            tail = _string_tail.match(buf, i + 1)
+            if tail is None:
+                return None
+            if depth == 0:
+                return tail.end()
+            match = _delimiters.search(buf, tail.end())
+            continue
+        if c in u'{[':
+            depth += 1
+        elif c in u'}]':
+            depth -= 1
+            if depth <= 0:
+                return i + 1
+        elif depth == 0:
+            # the comma or whitespace after a number or literal.
+            return i
+        match = _delimiters.search(buf, i + 1)
+    return None
+
+
+def parse_timestamp(value):
+    """
+    Parses the fixed layout ISO 8601 timestamps ceilometer gives us,
+    with or without fractional seconds, without going through strptime.
+    e.g. 2013-07-03T13:34:17 or 2013-07-03T13:34:17.123456
+    """
+    microsecond = 0
+    if len(value) > 20:
+        microsecond = int(value[20:26].ljust(6, '0'))
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    microsecond)
+
+
 def sort_entries(data):
     """
     Setup timestamps as datetime objects,
     and sort.
+    Ceilometer usually gives us entries already in order (newest first),
+    so that is checked for as we go and the sort skipped if possible.
     """
+    entries = []
+    ascending = descending = True
+    last = None
     for entry in data:
-        try:
-            entry['timestamp'] = datetime.strptime(
-                entry['timestamp'], date_format)
-        except ValueError:
-            entry['timestamp'] = datetime.strptime(
-                entry['timestamp'], other_date_format)
-    return sorted(data, key=lambda x: x['timestamp'])
+        timestamp = parse_timestamp(entry['timestamp'])
+        entry['timestamp'] = timestamp
+        if last is not None:
+            if timestamp < last:
+                ascending = False
+            if timestamp >= last:
+                descending = False
+        last = timestamp
+        entries.append(entry)
+
+    if ascending:
+        return entries
+    if descending:
+        # strictly descending, so reversing is the same as a stable sort.
+        entries.reverse()
+        return entries
+    entries.sort(key=lambda x: x['timestamp'])
+    return entries
+
+
+def slice_entries(entries, start, end):
+    """The sorted entries from start, up to but not including end."""
+    timestamps = [entry['timestamp'] for entry in entries]
+    return entries[bisect.bisect_left(timestamps, start):
+                   bisect.bisect_left(timestamps, end)]
+
+
+class UsageSpan(object):
+    """
+    Sorted entries for a meter across a range of windows, as fetched
+    in a single request, which can be cheaply sliced per window.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.timestamps = [entry['timestamp'] for entry in entries]
+
+    def window(self, start, end):
+        """The entries for a given window."""
+        lo = bisect.bisect_left(self.timestamps, start)
+        hi = bisect.bisect_left(self.timestamps, end)
+        return self.entries[lo:hi]
+
+
+class StatisticsSpan(object):
+    """
+    Per resource statistics for a meter across a range of windows, as
+    fetched in a single request with one period per window.
+    """
+    def __init__(self, statistics):
+        self.periods = {}
+        for row in statistics:
+            self.periods.setdefault(row['period_start'], []).append(row)
+        self.starts = sorted(self.periods)
+
+    def window(self, start, end):
+        """The statistics for each resource in a given window, combined
+           across periods if the window spans more than one."""
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_left(self.starts, end)
+        if hi - lo <= 1:
+            return self.periods[self.starts[lo]] if hi > lo else []
+
+        by_resource = OrderedDict()
+        for period_start in self.starts[lo:hi]:
+            for row in self.periods[period_start]:
+                resource_id = row['groupby']['resource_id']
+                by_resource.setdefault(resource_id, []).append(row)
+        return [merge_statistics(rows) for rows in by_resource.values()]
+
+
+def merge_statistics(rows):
+    """Combines the statistics of a resource over consecutive periods."""
+    merged = dict(rows[0])
+    for row in rows[1:]:
+        merged['max'] = max(merged['max'], row['max'])
+        merged['min'] = min(merged['min'], row['min'])
+        merged['sum'] += row['sum']
+        merged['count'] += row['count']
+    if merged['count']:
+        merged['avg'] = merged['sum'] / float(merged['count'])
+    return merged
+
+
+def partition_entries(data, key=itemgetter('project_id')):
+    """Splits sorted entries by the given key in a single pass,
+       keeping each partition sorted."""
+    partitions = {}
+    for entry in data:
+        partitions.setdefault(key(entry), []).append(entry)
+    return partitions
+
+
+class FleetUsage(object):
+    """
+    Usage fetched once for all projects and partitioned by project_id,
+    shared by the tenants of a collection run so that each meter is only
+    queried once per range, rather than once per tenant. At most
+    max_samples are held at once, the least recently used ranges being
+    dropped first, to be fetched again if they're needed again.
+    """
+    def __init__(self, max_samples=1000000):
+        self.max_samples = max_samples
+        self.samples = 0
+        self.lock = threading.Lock()
+        # least recently used first.
+        self.ranges = OrderedDict()
+        # where the run's earliest tenant starts, which fetches needn't
+        # reach back beyond.
+        self.floor = None
+
+    def _partitions(self, key, fetch):
+        with self.lock:
+            cached = self.ranges.pop(key, None)
+            if cached is None:
+                cached = {'lock': threading.Lock(),
+                          'partitions': None,
+                          'samples': 0}
+            self.ranges[key] = cached
+
+        # only one worker fetches a given range, the rest wait on it.
+        with cached['lock']:
+            if cached['partitions'] is None:
+                partitions = fetch()
+                with self.lock:
+                    cached['partitions'] = partitions
+                    cached['samples'] = sum(len(entries) for entries
+                                            in partitions.values())
+                    self.samples += cached['samples']
+                    self._evict(key)
+        return cached['partitions']
+
+    def _evict(self, keep):
+        for key in list(self.ranges):
+            if self.samples <= self.max_samples:
+                return
+            cached = self.ranges[key]
+            # ranges still being fetched aren't counted yet.
+            if key == keep or cached['partitions'] is None:
+                continue
+            del self.ranges[key]
+            self.samples -= cached['samples']
+
+    def usage(self, conn, meter_name, start, end, project_id):
+        partitions = self._partitions(
+            ('usage', meter_name, start, end),
+            lambda: partition_entries(conn.usage(meter_name, start, end)))
+        return partitions.get(project_id, [])
+
+    def statistics(self, conn, meter_name, start, end, period, project_id):
+        partitions = self._partitions(
+            ('statistics', meter_name, start, end, period),
+            lambda: partition_entries(
+                conn.statistics(meter_name, start, end, period),
+                key=lambda row: row['groupby']['project_id']))
+        return partitions.get(project_id, [])
+
+
+class ActiveMeters(object):
+    """
+    The meters each project has samples for across a collection run,
+    from the links of the project's resources, so that tenants and
+    meters with nothing to collect can be skipped without a query.
+    """
+    def __init__(self, resources):
+        self.projects = {}
+        for resource in resources:
+            meters = self.projects.setdefault(resource['project_id'], set())
+            meters.update(resource_meters(resource))
+
+    def meters(self, project_id):
+        return self.projects.get(project_id, frozenset())
 
 
 class Tenant(object):
@@ -115,6 +981,10 @@ class Tenant(object):
     def __init__(self, tenant, conn):
         self.tenant = tenant
         self.conn = conn            # the Interface object that produced us.
+        self.last_samples = {}
+        self.backfill = False
+        # how far collection has got, once it has looked.
+        self.last_collected = None
 
     @property
     def id(self):
@@ -128,23 +998,114 @@ class Tenant(object):
     def description(self):
         return self.tenant.description
 
-    def usage(self, meter_name, start, end):
+    @property
+    def fleet(self):
+        """The usage shared with the rest of the fleet, if any. Backfills
+           reach too far back to be worth sharing."""
+        return None if self.backfill else self.conn.fleet
+
+    def usage(self, meter_name, start, end, resource_id=None):
         """Queries ceilometer for all the entries in a given range,
            for a given meter, from this tenant."""
-        fields = [{'field': 'project_id', 'op': 'eq', 'value': self.tenant.id}]
-        fields.extend(add_dates(start - window_leadin, end))
+        if resource_id is not None:
+            return self.conn.usage(meter_name, start, end, self.tenant.id,
+                                   resource_id)
 
-        with timed('fetch global usage for meter %s' % meter_name):
-            endpoint = self.conn.auth.get_ceilometer_endpoint()
-            r = self.conn.session.get(
-                urlparse.urljoin(endpoint, '/v2/meters/%s' % meter_name),
-                headers={
-                    "X-Auth-Token": self.conn.auth.auth_token,
-                    "Content-Type": "application/json"
-                },
-                data=json.dumps({'q': fields}))
-
-            if r.status_code == 200:
-                return sort_entries(json.loads(r.text))
-            else:
-                raise InterfaceException('%d %s' % (r.status_code, r.text))
+        archived = self._archived(meter_name, start, end)
+        if archived is not None:
+            return archived
+
+        if self.fleet is not None:
+            usage = self.fleet.usage(self.conn, meter_name, start, end,
+                                     self.tenant.id)
+        else:
+            usage = self.conn.usage(meter_name, start, end, self.tenant.id)
+
+        self._archive(meter_name, start, end, usage)
+        return usage
+
+    def batch_usage(self, meter_names, start, end):
+        """Queries ceilometer for the entries of several meters in a given
+           range from this tenant in one request, returning them by meter."""
+        usage = {}
+        for meter_name in meter_names:
+            archived = self._archived(meter_name, start, end)
+            if archived is not None:
+                usage[meter_name] = archived
+
+        remaining = [m for m in meter_names if m not in usage]
+        if remaining:
+            try:
+                fetched = self.conn.query_samples(remaining, start, end,
+                                                  self.tenant.id)
+            except (ResponseTooLarge, QueryTimeout) as e:
+                # fetch them one by one instead, which can be split up.
+                log.info('batch fetch for %s too large, fetching by meter: '
+                         '%s' % (self.tenant.id, e))
+                fetched = dict((m, self.conn.usage(m, start, end,
+                                                   self.tenant.id))
+                               for m in remaining)
+
+            for meter_name, entries in fetched.items():
+                self._archive(meter_name, start, end, entries)
+            usage.update(fetched)
+        return usage
+
+    def batch_usage_spans(self, meter_names, start, end):
+        """As usage_span, for several meters in one request."""
+        return dict((meter_name, UsageSpan(usage)) for meter_name, usage
+                    in self.batch_usage(meter_names, start, end).items())
+
+    def _archive_variant(self):
+        # samples are shaped by the metadata keys they were projected to
+        # and the trusted source the query was limited to, so are only
+        # reused when those haven't changed since.
+        projection = self.conn.projection
+        return json.dumps(
+            {'metadata_keys': sorted(projection.metadata_keys)
+             if projection is not None else None,
+             'sources': [field['value'] for field in add_trust_sources()]},
+            sort_keys=True)
+
+    def _archived(self, meter_name, start, end):
+        # reprocessing a range we've fetched before reads it from disk.
+        store = archive.sample_archive
+        if store is not None:
+            archived = store.get(self.tenant.id, meter_name, start, end,
+                                 self._archive_variant())
+            if archived is not None:
+                return slice_entries(sort_entries(archived), start, end)
+        return None
+
+    def _archive(self, meter_name, start, end, usage):
+        store = archive.sample_archive
+        if store is not None:
+            store.put(self.tenant.id, meter_name, start, end,
+                      [dict(entry, timestamp=entry['timestamp'].isoformat())
+                       for entry in usage],
+                      self._archive_variant())
+
+    def usage_span(self, meter_name, start, end):
+        """Queries ceilometer for the entries of a meter across a range
+           of windows in one go, to be sliced up per window."""
+        return UsageSpan(self.usage(meter_name, start, end))
+
+    def statistics_span(self, meter_name, start, end, period):
+        """Queries ceilometer for per resource statistics of a meter
+           across a range of windows, one period per window."""
+        if self.fleet is not None:
+            statistics = self.fleet.statistics(
+                self.conn, meter_name, start, end, period, self.tenant.id)
+        else:
+            statistics = self.conn.statistics(meter_name, start, end,
+                                              period, self.tenant.id)
+        return StatisticsSpan(statistics)
+
+    def last_sample(self, meter_name, resource_id, end):
+        """The most recent sample for a resource, which is only fetched
+           the first time the resource is seen."""
+        key = (meter_name, resource_id)
+        if key not in self.last_samples:
+            self.last_samples[key] = self.conn.last_sample(
+                meter_name, resource_id, end)
+        return self.last_samples[key]
@@ -107,6 +107,43 @@ class Tenant(Base):
     resources = relationship(Resource, backref="tenant")
 
 
+class Lease(Base):
+    """A collector's claim on a piece of work, such as collecting a tenant,
+       which lapses if not renewed before it expires."""
+    __tablename__ = 'leases'
+    name = Column(String(100), primary_key=True)
+    holder = Column(String(255), nullable=False)
+    acquired = Column(DateTime)
+    expires = Column(DateTime, nullable=False)
+
+
+class CarriedState(Base):
+    """Transformer state for a resource, carried over from the end of the
+       last collected window into the next."""
+    __tablename__ = 'carried_states'
+    tenant_id = Column(
+        String(100),
+        ForeignKey("tenants.id"),
+        primary_key=True)
+    meter_name = Column(String(100), primary_key=True)
+    resource_id = Column(String(100), primary_key=True)
+    state = Column(Text, nullable=False)
+    # the end of the window the state was carried to.
+    as_of = Column(DateTime, nullable=False)
+
+
+class OpenWindow(Base):
+    """The start of a meter's collection window that hasn't closed yet,
+       for meters collected in windows wider than an hour."""
+    __tablename__ = 'open_windows'
+    tenant_id = Column(
+        String(100),
+        ForeignKey("tenants.id"),
+        primary_key=True)
+    meter_name = Column(String(100), primary_key=True)
+    start = Column(DateTime, nullable=False)
+
+
 class SalesOrder(Base):
     """Historic billing periods so that tenants
        cannot be rebilled accidentally."""
@@ -0,0 +1,127 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import Queue
+import sys
+import threading
+
+
+_done = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class Pipeline(object):
+    """
+    Passes items through a series of named stages, each running in its
+    own thread and reading from a bounded queue fed by the stage before,
+    so that the stages overlap while items stay in order. Each stage is
+    a function taking an item and returning an iterable of items for the
+    next stage. Iterating the pipeline yields what comes out of the last
+    stage, in the calling thread, raising any exception from a stage.
+    """
+
+    def __init__(self, source, stages, depth=2):
+        self.stopped = threading.Event()
+        self.queues = [(name, Queue.Queue(depth)) for name, _ in stages]
+        self.output = Queue.Queue(depth)
+        self.threads = []
+
+        inputs = [q for _, q in self.queues]
+        outputs = inputs[1:] + [self.output]
+        self._start(self._feed, source, inputs[0])
+        for (_, stage), inq, outq in zip(stages, inputs, outputs):
+            self._start(self._run, stage, inq, outq)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _put(self, queue, item):
+        # give up if the consumer has gone away, rather than block.
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+        raise PipelineStopped()
+
+    def _get(self, queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        raise PipelineStopped()
+
+    def _feed(self, source, outq):
+        try:
+            for item in source:
+                self._put(outq, item)
+            self._put(outq, _done)
+        except PipelineStopped:
+            pass
+        except Exception:
+            self._fail(outq)
+
+    def _run(self, stage, inq, outq):
+        try:
+            while True:
+                item = self._get(inq)
+                if item is _done or isinstance(item, _Failure):
+                    self._put(outq, item)
+                    return
+                for result in stage(item):
+                    self._put(outq, result)
+        except PipelineStopped:
+            pass
+        except Exception:
+            self._fail(outq)
+
+    def _fail(self, outq):
+        try:
+            self._put(outq, _Failure(sys.exc_info()))
+        except PipelineStopped:
+            pass
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.output.get()
+                if item is _done:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exc_info[0], item.exc_info[1], \
+                        item.exc_info[2]
+                yield item
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stops the stages, for when the caller gives up early."""
+        self.stopped.set()
+
+    def depths(self):
+        """The number of items waiting for each stage."""
+        return dict((name, queue.qsize()) for name, queue in self.queues)
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
@@ -0,0 +1,234 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import Queue
+import heapq
+import threading
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
+import logging as log
+
+from distil import database
+from distil.api import web
+from distil.helpers import reset_cache
+from distil.interface import Interface
+
+
+def collection_end(now, settle):
+    """The end of the last hour to have closed, settle time ago."""
+    return (now - settle).replace(minute=0, second=0, microsecond=0)
+
+
+def lag_queue(last_collected, costs, end):
+    """
+    A heap of the tenants that are behind end, most lagging first, and the
+    largest first among those lagging as much. Each item is
+    (-lag in windows, -cost, tenant id).
+    """
+    queue = []
+    for tenant_id, start in last_collected.items():
+        if start < end:
+            lag = int((end - start).total_seconds() //
+                      web.window_size.total_seconds())
+            queue.append((-lag, -costs.get(tenant_id, 0), tenant_id))
+    heapq.heapify(queue)
+    return queue
+
+
+class Scheduler(object):
+    """
+    Collects usage continuously, rather than a cycle per trigger. Tenants
+    that are behind are kept in a queue by how many windows they lag and
+    their size (resources known), and dispatched to the workers most
+    lagging first. A tenant still behind after its turn, which collects
+    at most max_windows_per_cycle windows, goes back into the queue. As
+    each hour closes the queue is rebuilt up to the new end, so that
+    tenants are collected as soon as their windows close.
+    """
+
+    retry_delay = 60
+
+    def __init__(self, concurrency, settle):
+        self.concurrency = concurrency
+        self.settle = settle
+        self.stopped = threading.Event()
+        # other collectors may run alongside, if leases are used.
+        self.holder = web.lease_holder()
+        # tenant sizes, as of the last refresh.
+        self.costs = {}
+
+    def stop(self):
+        """Stops dispatching, letting the tenants in progress finish."""
+        self.stopped.set()
+
+    def run(self):
+        interface = Interface()
+        pool = ThreadPool(self.concurrency)
+        done = Queue.Queue()
+        running = set()
+        queue = []
+        tenants = {}
+        end = None
+        last_run = None
+        lock = None
+
+        try:
+            while not self.stopped.is_set():
+                current = collection_end(datetime.utcnow(), self.settle)
+                if current != end:
+                    try:
+                        tenants, queue = self.refresh(interface, current,
+                                                      running)
+                    except Exception as e:
+                        # keystone or the database being away shouldn't
+                        # stop the scheduler; try again shortly.
+                        log.exception("Scheduler: refresh failed: %s" % e)
+                        self.stopped.wait(self.retry_delay)
+                        continue
+                    end = current
+
+                if queue and lock is None:
+                    lock = self.lock_run()
+                    if lock is None:
+                        # another run is going; let it finish first.
+                        self.stopped.wait(self.retry_delay)
+                        continue
+
+                while queue and len(running) < self.concurrency:
+                    lag, cost, tenant_id = heapq.heappop(queue)
+                    running.add(tenant_id)
+                    self.dispatch(pool, done, tenants[tenant_id], end,
+                                  interface)
+
+                if not running:
+                    if lock is not None:
+                        self.unlock_run(lock)
+                        lock = None
+                    if last_run != end and self.record_last_run(tenants,
+                                                                end):
+                        last_run = end
+                    # nothing left to do until the next hour closes.
+                    wake = end + web.window_size + self.settle
+                    delay = (wake - datetime.utcnow()).total_seconds()
+                    self.stopped.wait(max(delay, 0))
+                    continue
+
+                try:
+                    tenant_id, progressed = done.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                running.discard(tenant_id)
+
+                # only requeue tenants that moved, so that one failing
+                # tenant isn't retried over and over within the hour.
+                if progressed and tenant_id in tenants:
+                    self.requeue(queue, tenant_id, end)
+        finally:
+            pool.close()
+            pool.join()
+            if lock is not None:
+                self.unlock_run(lock)
+
+    def lock_run(self):
+        """Takes the run lock while there are tenants to collect, so that
+           triggered runs and backfills don't collect alongside. Returns
+           the lock, to be given back to unlock_run, or None if another
+           run holds it."""
+        lock = web.run_lock(database.Database(web.Session()))
+        try:
+            if lock.__enter__():
+                return lock
+            lock.__exit__(None, None, None)
+            log.info("Scheduler: waiting for the run in progress.")
+        except Exception as e:
+            log.exception("Scheduler: taking the run lock failed: %s" % e)
+        finally:
+            web.Session().close()
+        return None
+
+    def unlock_run(self, lock):
+        try:
+            lock.__exit__(None, None, None)
+        finally:
+            web.Session().close()
+
+    def refresh(self, interface, end, running):
+        """Lists the tenants, and queues those behind end."""
+        reset_cache()
+        tenants = dict((t.id, t) for t in interface.tenants)
+
+        session = web.Session()
+        try:
+            db = database.Database(session)
+            web.prepare_run(interface, db, tenants.values(), end)
+            last_collected = db.last_collected(tenants)
+            self.costs = db.resource_counts()
+        finally:
+            session.close()
+
+        for tenant_id in running:
+            last_collected.pop(tenant_id, None)
+        queue = lag_queue(last_collected, self.costs, end)
+
+        if queue:
+            log.info("Scheduler: %d tenants behind %s, the furthest by %d "
+                     "windows." % (len(queue), end, -queue[0][0]))
+        return tenants, queue
+
+    def record_last_run(self, tenants, end):
+        """Records end as the last run, once every tenant has reached it.
+           Returns whether it was recorded."""
+        session = web.Session()
+        try:
+            db = database.Database(session)
+            if any(start < end for start
+                   in db.last_collected(tenants).values()):
+                return False
+            with session.begin():
+                db.update_last_run(end)
+            return True
+        except Exception as e:
+            log.exception("Scheduler: recording the last run failed: %s" %
+                          e)
+            return False
+        finally:
+            session.close()
+
+    def dispatch(self, pool, done, tenant, end, interface):
+        def collect():
+            try:
+                run_once, resp = web.collect_tenant_usage(
+                    tenant, end, interface.fleet, interface.active,
+                    holder=self.holder)
+                if resp["errors"]:
+                    log.warning("Scheduler: %d errors collecting %s %s" %
+                                (resp["errors"], tenant.id, tenant.name))
+            except Exception as e:
+                log.exception("Scheduler: collecting %s %s failed: %s" %
+                              (tenant.id, tenant.name, e))
+                run_once = False
+            done.put((tenant.id, run_once))
+
+        pool.apply_async(collect)
+
+    def requeue(self, queue, tenant_id, end):
+        session = web.Session()
+        try:
+            db = database.Database(session)
+            last_collected = db.last_collected([tenant_id])
+        finally:
+            session.close()
+        for item in lag_queue(last_collected, self.costs, end):
+            heapq.heappush(queue, item)
+
@@ -0,0 +1,171 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import mmap
+import array
+import tempfile
+import multiprocessing
+import config
+import transformers
+from datetime import datetime, timedelta
+
+# the pool in use, if one is configured. See setup_transform_pool.
+transform_pool = None
+
+utc_epoch = datetime(1970, 1, 1)
+
+# shared memory, where there is any.
+shm_path = '/dev/shm'
+
+
+def setup_transform_pool():
+    """Starts the worker processes, which fork with the config loaded."""
+    processes = config.collection.get('transform_processes', 0)
+
+    global transform_pool
+    if transform_pool is not None:
+        transform_pool.close()
+    if processes > 1:
+        transform_pool = TransformPool(
+            processes, config.collection.get('transform_pool_min_samples',
+                                             10000))
+    else:
+        transform_pool = None
+
+
+class TransformPool(object):
+    """
+    Runs the Uptime transformer for many resources at once across worker
+    processes. Samples are packed into columns (timestamps, volumes,
+    flavors, and where each resource starts) in a file in shared memory,
+    which workers map and read rather than having each sample pickled,
+    and only the per resource results are sent back.
+    """
+
+    def __init__(self, processes, min_samples):
+        self.processes = processes
+        self.min_samples = min_samples
+        self.pool = multiprocessing.Pool(processes)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def handles(self, transformer, usage_by_resource):
+        """Whether it's worth using the pool for the given usage."""
+        return (type(transformer) is transformers.Uptime and
+                sum(len(entries) for entries in usage_by_resource.values())
+                >= self.min_samples)
+
+    def transform(self, name, usage_by_resource, start, end):
+        """Transforms the usage of each resource, as transform_usage."""
+        resources = usage_by_resource.keys()
+        if not resources:
+            return {}
+        columns = pack_columns([usage_by_resource[res] for res in resources])
+        flavors = columns.pop('flavors')
+
+        directory = shm_path if os.path.isdir(shm_path) else None
+        fd, path = tempfile.mkstemp(prefix='distil-', dir=directory)
+        try:
+            layout = write_columns(fd, columns)
+            chunk = -(-len(resources) // self.processes)
+            tasks = [(path, layout, flavors, i, min(i + chunk, len(resources)),
+                      start, end)
+                     for i in range(0, len(resources), chunk)]
+            results = sum(self.pool.map(_uptime_worker, tasks), [])
+        finally:
+            os.close(fd)
+            os.unlink(path)
+
+        # flavor names are looked up here, where they're cached.
+        uptime = transformers.Uptime()
+        return dict((res, uptime.flavor_names(usage))
+                    for res, usage in zip(resources, results))
+
+
+def pack_columns(entries_by_resource):
+    """Packs the entries the Uptime transformer reads into columns."""
+    offsets = array.array('l', [0])
+    # microseconds since the epoch, which 64 bit longs hold exactly.
+    timestamps = array.array('l')
+    volumes = array.array('d')
+    flavor_ids = array.array('l')
+    flavors = {}
+
+    clean = transformers.Uptime()._clean_entry
+    for entries in entries_by_resource:
+        for entry in entries:
+            entry = clean(entry)
+            delta = entry['timestamp'] - utc_epoch
+            timestamps.append((delta.days * 86400 + delta.seconds) * 1000000 +
+                              delta.microseconds)
+            volumes.append(entry['counter_volume'])
+            flavor_ids.append(flavors.setdefault(entry['flavor'],
+                                                 len(flavors)))
+        offsets.append(len(timestamps))
+
+    return {'offsets': offsets, 'timestamps': timestamps, 'volumes': volumes,
+            'flavor_ids': flavor_ids,
+            'flavors': sorted(flavors, key=flavors.get)}
+
+
+def write_columns(fd, columns):
+    """Writes columns to a file, returning where each one is."""
+    layout = {}
+    offset = 0
+    for name, column in columns.items():
+        data = column.tostring()
+        os.write(fd, data)
+        layout[name] = (column.typecode, offset, len(data))
+        offset += len(data)
+    return layout
+
+
+def read_columns(path, layout):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        columns = {}
+        for name, (typecode, offset, length) in layout.items():
+            column = array.array(typecode)
+            column.fromstring(m[offset:offset + length])
+            columns[name] = column
+        return columns
+    finally:
+        m.close()
+
+
+def _uptime_worker(task):
+    """Runs Uptime for a range of the packed resources, in a worker."""
+    path, layout, flavors, first, last, start, end = task
+    columns = read_columns(path, layout)
+    offsets = columns['offsets']
+    timestamps = columns['timestamps']
+    volumes = columns['volumes']
+    flavor_ids = columns['flavor_ids']
+
+    uptime = transformers.Uptime()
+    results = []
+    for res in range(first, last):
+        entries = [{'timestamp': utc_epoch + timedelta(
+                        microseconds=timestamps[i]),
+                    'counter_volume': volumes[i],
+                    'resource_metadata': {'flavor.id':
+                                          flavors[flavor_ids[i]]}}
+                   for i in range(offsets[res], offsets[res + 1])]
+        results.append(uptime.usage_by_flavor(entries, start, end))
+    return results
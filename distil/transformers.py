@@ -18,21 +18,59 @@ import helpers
 import config
 
 
+class NeedsSamples(Exception):
+    """Raised when a resource's statistics aren't enough to transform it,
+       and its raw samples are needed instead."""
+    pass
+
+
 class Transformer(object):
+    # the resource_metadata keys this transformer reads from samples.
+    metadata_keys = ()
+
+    @classmethod
+    def required_metadata(cls):
+        return cls.metadata_keys
+
     def transform_usage(self, name, data, start, end):
         return self._transform_usage(name, data, start, end)
 
     def _transform_usage(self, name, data, start, end):
         raise NotImplementedError
 
+    def transform_statistics(self, name, stats, entry, start, end):
+        """
+        Transforms the ceilometer statistics (max, sum, etc.) for a single
+        resource in a window, rather than its samples. entry is the most
+        recent sample for the resource, for its metadata.
+        """
+        return self._transform_statistics(name, stats, entry, start, end)
+
+    def _transform_statistics(self, name, stats, entry, start, end):
+        raise NotImplementedError
+
+    def carry_over(self, data, start, end):
+        """
+        The compact state of a resource to carry over from a window into
+        the next, from the entries transformed for the window. It's put
+        before the next window's entries, so needs the same shape as an
+        entry. None when nothing needs to be carried over.
+        """
+        return None
+
 
 class Uptime(Transformer):
     """
     Transformer to calculate uptime based on states,
     which is broken apart into flavor at point in time.
     """
+    metadata_keys = ('flavor.id', 'instance_flavor_id')
 
     def _transform_usage(self, name, data, start, end):
+        return self.flavor_names(self.usage_by_flavor(data, start, end))
+
+    def usage_by_flavor(self, data, start, end):
+        """The seconds of uptime in the window, by flavor id."""
         # get tracked states from config
         tracked = config.transformers['uptime']['tracked_states']
 
@@ -82,9 +120,22 @@ class Uptime(Transformer):
             diff = end - last_timestamp
             _add_usage(diff)
 
+        return usage_dict
+
+    def flavor_names(self, usage_dict):
         # map the flavors to names on the way out
         return {helpers.flavor_name(f): v for f, v in usage_dict.items()}
 
+    def carry_over(self, data, start, end):
+        # the state in force at the start of the next window.
+        state = [s for s in data if s['timestamp'] < end]
+        if not state:
+            return None
+        last_state = self._clean_entry(state[-1])
+        return {'counter_volume': last_state['counter_volume'],
+                'timestamp': last_state['timestamp'],
+                'resource_metadata': {'flavor.id': last_state['flavor']}}
+
     def _clean_entry(self, entry):
         result = {
             'counter_volume': entry['counter_volume'],
@@ -106,6 +157,11 @@ class FromImage(Transformer):
     This relies heaviliy on instance metadata.
     """
 
+    @classmethod
+    def required_metadata(cls):
+        from_image = config.transformers['from_image']
+        return tuple(from_image['md_keys']) + tuple(from_image['size_keys'])
+
     def _transform_usage(self, name, data, start, end):
         checks = config.transformers['from_image']['md_keys']
         none_values = config.transformers['from_image']['none_values']
@@ -144,6 +200,10 @@ class GaugeMax(Transformer):
         hours = (end - start).total_seconds() / 3600.0
         return {name: max_vol * hours}
 
+    def _transform_statistics(self, name, stats, entry, start, end):
+        hours = (end - start).total_seconds() / 3600.0
+        return {name: stats['max'] * hours}
+
 
 class StorageMax(Transformer):
     """
@@ -151,6 +211,7 @@ class StorageMax(Transformer):
     volume_type and uses that as the service, or uses the
     default service name.
     """
+    metadata_keys = ('volume_type',)
 
     def _transform_usage(self, name, data, start, end):
 
@@ -159,16 +220,22 @@ class StorageMax(Transformer):
 
         max_vol = max([v["counter_volume"] for v in data])
 
-        if "volume_type" in data[-1]['resource_metadata']:
-            vtype = data[-1]['resource_metadata']['volume_type']
+        hours = (end - start).total_seconds() / 3600.0
+        return {self._service(name, data[-1]): max_vol * hours}
+
+    def _transform_statistics(self, name, stats, entry, start, end):
+        hours = (end - start).total_seconds() / 3600.0
+        return {self._service(name, entry): stats['max'] * hours}
+
+    def _service(self, name, entry):
+        if entry and "volume_type" in entry['resource_metadata']:
+            vtype = entry['resource_metadata']['volume_type']
             service = helpers.volume_type(vtype)
             if not service:
                 service = name
         else:
             service = name
-
-        hours = (end - start).total_seconds() / 3600.0
-        return {service: max_vol * hours}
+        return service
 
 
 class GaugeSum(Transformer):
@@ -183,6 +250,9 @@ class GaugeSum(Transformer):
                 sum_vol += sample["counter_volume"]
         return {name: sum_vol}
 
+    def _transform_statistics(self, name, stats, entry, start, end):
+        return {name: stats['sum']}
+
 
 class GaugeNetworkService(Transformer):
     """Transformer for Neutron network service, such as LBaaS, VPNaaS,
@@ -200,6 +270,18 @@ class GaugeNetworkService(Transformer):
         hours = (end - start).total_seconds() / 3600.0
         return {name: max_vol * hours}
 
+    def _transform_statistics(self, name, stats, entry, start, end):
+        # the max is only usable if no sample was >= 2, and when the
+        # min is 1 the answer must be 1; anything else is ambiguous.
+        if stats['max'] < 2:
+            max_vol = stats['max']
+        elif stats['min'] == 1:
+            max_vol = 1
+        else:
+            raise NeedsSamples()
+        hours = (end - start).total_seconds() / 3600.0
+        return {name: max_vol * hours}
+
 # Transformer dict for us with the config.
 # All usable transformers need to be here.
 active_transformers = {
@@ -0,0 +1,69 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Micro-benchmark for sort_entries, built from the samples in the
+tests/data fixtures. Run with: python -m tests.bench_sort_entries
+"""
+
+import timeit
+from datetime import datetime
+from distil import interface
+from distil.constants import date_format, other_date_format
+from .data_samples import MAPPINGS
+
+
+def strptime_sort_entries(data):
+    """sort_entries as it was, for comparison."""
+    for entry in data:
+        try:
+            entry['timestamp'] = datetime.strptime(
+                entry['timestamp'], date_format)
+        except ValueError:
+            entry['timestamp'] = datetime.strptime(
+                entry['timestamp'], other_date_format)
+    return sorted(data, key=lambda x: x['timestamp'])
+
+
+def fixture_samples():
+    samples = []
+    for value in MAPPINGS.values():
+        if isinstance(value, list):
+            samples.extend(s for s in value
+                           if isinstance(s, dict) and 'timestamp' in s)
+    return samples
+
+
+def bench(name, func, samples, number):
+    # sort_entries replaces timestamps in place, so each run gets a copy
+    # of the entries (just the fields we need, to keep the copy cheap).
+    copies = [[{'timestamp': s['timestamp']} for s in samples]
+              for i in range(number)]
+    data = iter(copies)
+    seconds = timeit.timeit(lambda: func(next(data)), number=number)
+    print "%-32s %8.2f us/sample" % (name,
+                                     seconds * 1e6 / (number * len(samples)))
+
+
+if __name__ == '__main__':
+    samples = fixture_samples()
+    newest_first = sorted(samples, key=lambda s: s['timestamp'], reverse=True)
+    number = 20
+
+    print "%d samples from tests/data fixtures" % len(samples)
+    for order, data in (('fixture order', samples),
+                        ('newest first', newest_first)):
+        bench('strptime (%s)' % order, strptime_sort_entries, data, number)
+        bench('sort_entries (%s)' % order, interface.sort_entries,
+              data, number)
@@ -16,12 +16,13 @@ from webtest import TestApp
 from . import test_interface, helpers, constants
 from distil.api import web
 from distil.api.web import get_app
-from distil import models
+from distil import models, database
 from distil import interface
 from distil.helpers import convert_to
 from distil.constants import dawn_of_time
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
+from sqlalchemy.orm import create_session
 import unittest
 import json
 import mock
@@ -251,3 +252,498 @@ class TestApi(test_interface.TestInterface):
         resp = self.app.get("/last_collected")
         resp_json = json.loads(resp.body)
         self.assertEquals(resp_json['last_collected'], str(dawn_of_time))
+
+    def test_get_concurrency(self):
+        """The adaptive concurrency limit and its last change are
+           reported, and nothing when it isn't adaptive."""
+        resp = self.app.get("/concurrency")
+        self.assertEquals(json.loads(resp.body), {})
+
+        limiter = interface.ConcurrencyLimiter(1, 8, 10.0)
+        limiter._set(4, 'responses within the 10.0s target')
+        limiter._set(2, 'response took 12.0s, over the 10.0s target')
+        with mock.patch.object(interface, 'concurrency_limiter', limiter):
+            resp = self.app.get("/concurrency")
+
+        resp_json = json.loads(resp.body)
+        self.assertEquals(resp_json['limit'], 2)
+        self.assertEquals(resp_json['last_change']['reason'],
+                          'response took 12.0s, over the 10.0s target')
+        self.assertEquals([c['limit'] for c in resp_json['changes']],
+                          [4, 2])
+
+    def test_usage_run_concurrent(self):
+        """Concurrent collection should merge every tenant's results
+           into the one response, and update the last run."""
+        def fake_collect(tenant, db, session, resp, end, backfill=False,
+                         max_windows=None, deadline=None):
+            resp["tenants"].append({"id": tenant.id, "updated": True})
+            return True
+
+        tenants = []
+        for i in range(5):
+            t = mock.Mock(spec=interface.Tenant)
+            t.id = "tenant_id_" + str(i)
+            tenants.append(t)
+
+        with mock.patch('distil.api.web.Interface') as Interface:
+            Interface.return_value.tenants = tenants
+            with mock.patch('distil.api.web.collect_usage') as collect:
+                collect.side_effect = fake_collect
+                with mock.patch.dict(web.config.collection,
+                                     {'concurrency': 3}):
+                    resp = self.app.post("/collect_usage")
+
+        resp_json = json.loads(resp.body)
+        self.assertEquals(resp_json['errors'], 0)
+        self.assertEquals(sorted(t['id'] for t in resp_json['tenants']),
+                          sorted(t.id for t in tenants))
+        self.assertEquals(self.session.query(models._Last_Run).count(), 1)
+
+    def test_usage_run_concurrent_failure(self):
+        """A tenant failing in a concurrent run is reported without
+           losing the others, and the run doesn't count as the last."""
+        def fake_collect(tenant, db, session, resp, end, backfill=False,
+                         max_windows=None, deadline=None):
+            if tenant.id == "tenant_id_2":
+                raise ValueError("boom")
+            resp["tenants"].append({"id": tenant.id, "updated": True})
+            return True
+
+        tenants = []
+        for i in range(5):
+            t = mock.Mock(spec=interface.Tenant)
+            t.id = "tenant_id_" + str(i)
+            tenants.append(t)
+
+        with mock.patch('distil.api.web.Interface') as Interface:
+            Interface.return_value.tenants = tenants
+            with mock.patch('distil.api.web.collect_usage') as collect:
+                collect.side_effect = fake_collect
+                with mock.patch.dict(web.config.collection,
+                                     {'concurrency': 3}):
+                    resp = self.app.post("/collect_usage")
+
+        resp_json = json.loads(resp.body)
+        self.assertEquals(resp_json['errors'], 1)
+        self.assertEquals(len(resp_json['tenants']), 5)
+        failed = [t for t in resp_json['tenants'] if t.get('failed')]
+        self.assertEquals([t['id'] for t in failed], ["tenant_id_2"])
+        self.assertEquals(self.session.query(models._Last_Run).count(), 0)
+
+    def test_usage_run_budget(self):
+        """A budgeted run takes turns round-robin, a fetch's worth of
+           windows at a time, and reports the tenants still behind."""
+        turns = []
+        lags = {'tenant_a': 3, 'tenant_b': 1}
+
+        def fake_collect(tenant, db, session, resp, end, backfill=False,
+                         max_windows=None, deadline=None):
+            self.assertEquals(max_windows, 1)
+            turns.append(tenant.id)
+            lags[tenant.id] -= 1
+            tenant.last_collected = end - timedelta(hours=lags[tenant.id])
+            resp["tenants"].append({"id": tenant.id, "updated": True})
+            return True
+
+        tenants = []
+        for tenant_id in sorted(lags):
+            t = mock.Mock(spec=interface.Tenant)
+            t.id = tenant_id
+            tenants.append(t)
+
+        with mock.patch('distil.api.web.Interface') as Interface:
+            Interface.return_value.tenants = tenants
+            with mock.patch('distil.api.web.collect_usage') as collect:
+                collect.side_effect = fake_collect
+                with mock.patch.dict(web.config.collection,
+                                     {'concurrency': 1,
+                                      'windows_per_fetch': 1}):
+                    resp = self.app.post_json("/collect_usage",
+                                              {"budget_seconds": 60})
+
+        resp_json = json.loads(resp.body)
+        self.assertEquals(turns, ['tenant_a', 'tenant_b',
+                                  'tenant_a', 'tenant_a'])
+        self.assertEquals(len(resp_json['tenants']), 4)
+        self.assertTrue('behind' in resp_json)
+
+    def test_usage_run_leased(self):
+        """Tenants leased by another collector are skipped."""
+        def fake_collect(tenant, db, session, resp, end, backfill=False,
+                         max_windows=None, deadline=None):
+            resp["tenants"].append({"id": tenant.id, "updated": True})
+            return True
+
+        tenants = []
+        for i in range(2):
+            t = mock.Mock(spec=interface.Tenant)
+            t.id = "tenant_id_" + str(i)
+            tenants.append(t)
+
+        db = database.Database(self.session)
+        db.claim_lease('tenant:tenant_id_0', 'elsewhere', timedelta(hours=1))
+        self.session.commit()
+
+        with mock.patch('distil.api.web.Interface') as Interface:
+            Interface.return_value.tenants = tenants
+            with mock.patch('distil.api.web.collect_usage') as collect:
+                collect.side_effect = fake_collect
+                with mock.patch.dict(web.config.collection,
+                                     {'leases': {'seconds': 60},
+                                      'concurrency': 1}):
+                    resp = self.app.post("/collect_usage")
+
+        resp_json = json.loads(resp.body)
+        self.assertEquals(resp_json['tenants'],
+                          [{"id": "tenant_id_0", "updated": False,
+                            "skipped": "Collected elsewhere"},
+                           {"id": "tenant_id_1", "updated": True}])
+        # the lease taken for the run is given up afterwards.
+        self.assertEquals(self.session.query(models.Lease).count(), 1)
+
+    def test_usage_run_single_flight(self):
+        """A run triggered while another is going reports on that run
+           instead of collecting."""
+        db = database.Database(self.session)
+        db.claim_lease('collect_usage', 'elsewhere', timedelta(hours=1))
+        self.session.commit()
+
+        with mock.patch('distil.api.web.collect_tenants') as collect:
+            resp = self.app.post("/collect_usage")
+
+        resp_json = json.loads(resp.body)
+        self.assertFalse(collect.called)
+        self.assertEquals(resp_json['status'], 'already running')
+        self.assertEquals(resp_json['holder'], 'elsewhere')
+        self.assertEquals(resp_json['progress'],
+                          {'tenants': 0, 'collected': 0})
+
+        # and once it's done, the next trigger runs.
+        db.release_lease('collect_usage', 'elsewhere')
+        self.session.commit()
+        with mock.patch('distil.api.web.collect_tenants') as collect:
+            collect.return_value = '{}'
+            self.app.post("/collect_usage")
+        self.assertTrue(collect.called)
+
+    def test_run_lock(self):
+        """Backfills wait on a run in progress too, but with tenant leases
+           runs aren't locked at all."""
+        db = database.Database(self.session)
+        db.claim_lease('collect_usage', 'elsewhere', timedelta(hours=1))
+        self.session.commit()
+
+        with mock.patch('distil.api.web.collect_tenants') as collect:
+            resp = self.app.post_json("/backfill", {"tenants": ["a"]})
+        self.assertFalse(collect.called)
+        self.assertEquals(json.loads(resp.body)['status'],
+                          'already running')
+
+        with mock.patch('distil.api.web.collect_tenants') as collect:
+            collect.return_value = '{}'
+            with mock.patch.dict(web.config.collection,
+                                 {'leases': {'seconds': 60}}):
+                self.app.post("/collect_usage")
+        self.assertTrue(collect.called)
+        self.assertEquals(self.session.query(models.Lease).count(), 0)
+
+    def test_collect_usage_windows(self):
+        """collect_usage writes usage a window at a time, saving how far
+           it got, the carried states and the open windows along with
+           each, and stops at a window that can't be written."""
+        t0 = datetime(2014, 1, 1)
+        end = t0 + timedelta(hours=4)
+
+        db = database.Database(self.session)
+        db_tenant = db.insert_tenant('tenant', 'a', '', t0)
+        db_tenant.last_collected = t0
+        # the third window's usage is already there.
+        db.insert_resource('tenant', 'vm', 'Virtual Machine', t0,
+                           {'resource_metadata': {}}, {})
+        db.insert_usage('tenant', 'vm', {'m1.tiny': 1}, 'second',
+                        t0 + timedelta(hours=2), t0 + timedelta(hours=3),
+                        t0)
+        self.session.commit()
+
+        samples = {
+            'state': [{'timestamp': t0 + timedelta(minutes=m),
+                       'resource_id': 'vm', 'source': 'openstack',
+                       'counter_volume': 1,
+                       'resource_metadata': {'flavor.id': '1'}}
+                      for m in range(0, 240, 30)],
+            'ip.floating': [{'timestamp': t0 + timedelta(minutes=m),
+                             'resource_id': 'ip', 'source': 'openstack',
+                             'counter_volume': 1,
+                             'resource_metadata': {}}
+                            for m in range(0, 240, 30)]}
+
+        class FakeTenant(object):
+            id = 'tenant'
+            name = 'a'
+            description = ''
+            conn = mock.Mock(active=None)
+            fleet = None
+
+            def usage_span(self, meter_name, start, end):
+                return interface.UsageSpan(
+                    [entry for entry in samples[meter_name]
+                     if start <= entry['timestamp'] < end])
+
+        mappings = {
+            'state': {'type': 'Virtual Machine', 'transformer': 'Uptime',
+                      'unit': 'second', 'metadata': {}},
+            'ip.floating': {'type': 'Floating IP', 'window': '6h',
+                            'transformer': 'GaugeMax', 'unit': 'hour',
+                            'metadata': {}}}
+
+        tenant = FakeTenant()
+        session = create_session(bind=self.session.bind)
+        resp = {"tenants": [], "errors": 0}
+        with mock.patch.dict(web.config.collection,
+                             {'meter_mappings': mappings}):
+            with mock.patch('distil.helpers.flavor_name',
+                            lambda f_id: 'm1.tiny'):
+                run_once = web.collect_usage(tenant, database.Database(
+                    session), session, resp, end)
+        session.close()
+
+        self.assertTrue(run_once)
+        self.assertEquals(resp['errors'], 1)
+        self.assertEquals([t['updated'] for t in resp['tenants']],
+                          [True, True, False])
+        self.assertEquals(tenant.last_collected, t0 + timedelta(hours=2))
+
+        self.session.expire_all()
+        db = database.Database(self.session)
+        self.assertEquals(
+            self.session.query(models.Tenant.last_collected).scalar(),
+            t0 + timedelta(hours=2))
+        usage = self.session.query(models.UsageEntry.start,
+                                   models.UsageEntry.volume).\
+            filter(models.UsageEntry.resource_id == 'vm').\
+            order_by(models.UsageEntry.start).all()
+        self.assertEquals(usage,
+                          [(t0, 3600), (t0 + timedelta(hours=1), 3600),
+                           (t0 + timedelta(hours=2), 1)])
+        self.assertEquals(self.session.query(models.UsageEntry).filter(
+            models.UsageEntry.resource_id == 'ip').count(), 0)
+
+        states = db.carried_states('tenant', t0 + timedelta(hours=2))
+        self.assertEquals(states['state']['vm']['timestamp'],
+                          t0 + timedelta(minutes=90))
+        self.assertEquals(db.open_windows('tenant'), {'ip.floating': t0})
+
+    def test_collect_usage_idle(self):
+        """A tenant with no active meters skips straight to the end,
+           however many windows a cycle would otherwise collect."""
+        t0 = datetime(2014, 1, 1)
+        end = t0 + timedelta(hours=10)
+
+        db = database.Database(self.session)
+        db_tenant = db.insert_tenant('tenant', 'a', '', t0)
+        db_tenant.last_collected = t0
+        self.session.commit()
+
+        tenant = mock.Mock(id='tenant', description='', fleet=None)
+        tenant.conn.active.meters.return_value = frozenset()
+        session = create_session(bind=self.session.bind)
+        resp = {"tenants": [], "errors": 0}
+        with mock.patch.dict(web.config.collection,
+                             {'meter_mappings': {'state': {}},
+                              'max_windows_per_cycle': 2}):
+            self.assertTrue(web.collect_usage(
+                tenant, database.Database(session), session, resp, end))
+        session.close()
+
+        self.assertEquals(tenant.last_collected, end)
+        self.session.expire_all()
+        self.assertEquals(
+            self.session.query(models.Tenant.last_collected).scalar(), end)
+
+    def test_fetch_spans_concurrent(self):
+        """Concurrent meter fetches should still map each span
+           back to its own meter."""
+        tenant = mock.Mock(spec=interface.Tenant)
+        tenant.usage_span.side_effect = lambda m, s, e: (m, s, e)
+        mappings = {'meter_%s' % i: {} for i in range(9)}
+        start, end = datetime(2014, 1, 1), datetime(2014, 1, 2)
+
+        with mock.patch.dict(web.config.collection,
+                             {'meter_concurrency': 4}):
+            spans = web.fetch_spans(tenant, start, end, mappings)
+
+        self.assertEquals(spans, {m: (m, start, end) for m in mappings})
+
+    def test_fetch_spans_batched(self):
+        """Batched sample meters share one fetch, while statistics
+           meters are still fetched on their own."""
+        tenant = mock.Mock(spec=interface.Tenant)
+        tenant.fleet = None
+        tenant.batch_usage_spans.side_effect = \
+            lambda ms, s, e: {m: (m, s, e) for m in ms}
+        tenant.statistics_span.return_value = 'stats'
+        mappings = {'meter_%s' % i: {} for i in range(3)}
+        mappings['stats_meter'] = {'statistics': True}
+        start, end = datetime(2014, 1, 1), datetime(2014, 1, 2)
+
+        with mock.patch.dict(web.config.collection,
+                             {'meter_concurrency': 4,
+                              'batch_meters': True}):
+            spans = web.fetch_spans(tenant, start, end, mappings)
+
+        self.assertEquals(tenant.batch_usage_spans.call_count, 1)
+        self.assertEquals(spans['stats_meter'], 'stats')
+        for i in range(3):
+            m = 'meter_%s' % i
+            self.assertEquals(spans[m], (m, start, end))
+
+    def test_backfill_batches(self):
+        """Backfilled windows are written a fetch at a time, and
+           otherwise one window at a time."""
+        start = datetime(2014, 1, 1)
+        end = datetime(2014, 1, 4)
+        windows = list(web.generate_windows(start, end))
+
+        with mock.patch.dict(web.config.collection,
+                             {'backfill': {'lag_hours': 48,
+                                           'hours_per_fetch': 24}}):
+            self.assertTrue(web.should_backfill(start, end))
+            self.assertFalse(web.should_backfill(start, start + timedelta(
+                hours=48)))
+            batches = web.batch_windows(windows, end, True)
+
+        self.assertEquals([len(b) for b in batches], [24, 24, 24])
+        self.assertEquals(sum(batches, []), windows)
+        self.assertEquals(len(web.batch_windows(windows, end, False)), 72)
+
+    def test_window_closes(self):
+        """Meter windows close on UTC boundaries of their width, or
+           early when adaptive and a volume changes."""
+        t0 = datetime(2014, 1, 1)
+        self.assertEquals(web.meter_window({}), timedelta(hours=1))
+        self.assertEquals(web.meter_window({'window': '6h'}),
+                          timedelta(hours=6))
+        self.assertEquals(web.meter_window({'window': '1d'}),
+                          timedelta(days=1))
+        # windows that don't divide a day would cross UTC midnight.
+        for window in ('5h', '7h', '2d', '0h'):
+            self.assertRaises(ValueError, web.meter_window,
+                              {'window': window})
+        with mock.patch.dict(web.config.collection,
+                             {'meter_mappings': {'m': {'window': '5h'}}}):
+            self.assertRaises(ValueError, web.check_meter_windows)
+
+        span = interface.UsageSpan([
+            {'timestamp': t0 + timedelta(minutes=m), 'resource_id': 'a',
+             'counter_volume': 1 if m < 90 else 2}
+            for m in range(0, 180, 30)])
+        daily = {'window': '1d'}
+        adaptive = {'window': '1d', 'adaptive_window': True}
+
+        for hours, closes in ((1, False), (2, False), (24, True)):
+            self.assertEquals(web.window_closes(
+                span, daily, t0, t0 + timedelta(hours=hours)), closes)
+        for hours, closes in ((1, False), (2, True)):
+            self.assertEquals(web.window_closes(
+                span, adaptive, t0, t0 + timedelta(hours=hours)), closes)
+
+    def test_wide_window_hourly(self):
+        """Wide windows are totalled hour by hour, so a resource is only
+           billed for the hours it was around."""
+        t0 = datetime(2014, 1, 1)
+        span = interface.UsageSpan([
+            {'timestamp': t0 + timedelta(minutes=m), 'resource_id': 'a',
+             'source': 'openstack', 'counter_volume': 1}
+            for m in range(240, 360, 30)])
+        meter_info = {'window': '6h', 'transformer': 'GaugeMax',
+                      'service': 'n1.ipv4', 'type': 'Floating IP',
+                      'unit': 'hour', 'metadata': {}}
+        db = mock.Mock()
+        tenant = mock.Mock(id='tenant')
+
+        web.collect_meter(tenant, span, 'ip.floating', meter_info, t0,
+                          t0 + timedelta(hours=6), db, t0, {})
+
+        db.insert_usage.assert_called_once_with(
+            'tenant', 'a', {'n1.ipv4': 2.0}, 'hour', t0,
+            t0 + timedelta(hours=6), t0)
+
+    def test_statistics_metadata(self):
+        """The last sample is only fetched for its metadata when the meter
+           or its transformer reads any."""
+        t0 = datetime(2014, 1, 1)
+        statistics = [{'groupby': {'resource_id': 'a'}, 'max': 2}]
+        meter_info = {'transformer': 'GaugeMax', 'type': 'Floating IP',
+                      'unit': 'hour', 'metadata': {}}
+        tenant = mock.Mock(id='tenant')
+        tenant.last_sample.return_value = {
+            'resource_metadata': {'address': '10.0.0.1'}}
+        transformer = web.transformers['GaugeMax']()
+
+        web.transform_statistics_and_insert(
+            tenant, statistics, transformer, 'n1.ipv4', 'ip.floating',
+            meter_info, t0, t0 + timedelta(hours=1), mock.Mock(), t0)
+        self.assertFalse(tenant.last_sample.called)
+
+        meter_info['metadata'] = {'ip address': {'sources': ['address']}}
+        web.transform_statistics_and_insert(
+            tenant, statistics, transformer, 'n1.ipv4', 'ip.floating',
+            meter_info, t0, t0 + timedelta(hours=1), mock.Mock(), t0)
+        tenant.last_sample.assert_called_once_with(
+            'ip.floating', 'a', t0 + timedelta(hours=1))
+
+    def test_fetch_ranges(self):
+        """Batches are grouped by the range fetched for them, with wide
+           meters fetched from their last boundary."""
+        start = datetime(2014, 1, 1, 3)
+        end = start + timedelta(hours=48)
+        windows = list(web.generate_windows(start, end))
+        batches = web.batch_windows(windows, end, False)
+
+        with mock.patch.dict(web.config.collection,
+                             {'windows_per_fetch': 24}):
+            ranges = web.fetch_ranges(batches, end, end, False)
+
+        self.assertEquals([(s, e, len(b)) for s, e, b in ranges],
+                          [(start, start + timedelta(hours=24), 24),
+                           (start + timedelta(hours=24), end, 24)])
+
+        # fleet fetches share a grid ending at the run's end, from no
+        # earlier than the run's earliest tenant.
+        end = datetime(2014, 1, 2, 23)
+        with mock.patch.dict(web.config.collection,
+                             {'windows_per_fetch': 24,
+                              'fleet_fetch': True}):
+            self.assertEquals(
+                web.fetch_range(end - timedelta(hours=1), end, end,
+                                floor=end - timedelta(hours=1)),
+                (end - timedelta(hours=1), end))
+            self.assertEquals(
+                web.fetch_range(end - timedelta(hours=30), end, end,
+                                floor=end - timedelta(hours=30)),
+                (end - timedelta(hours=30), end - timedelta(hours=24)))
+            self.assertEquals(
+                web.fetch_range(end - timedelta(hours=3), end, end),
+                (end - timedelta(hours=24), end))
+
+        mappings = {'hourly': {}, 'daily': {'window': '1d'}}
+        self.assertEquals(web.meter_fetch_starts(mappings, start, {}),
+                          {'daily': datetime(2014, 1, 1)})
+
+    def test_filter_and_group_untrusted(self):
+        """Untrusted samples are dropped and counted by source."""
+        usage = [{'source': 'openstack', 'resource_id': 'a'},
+                 {'source': 'openstack', 'resource_id': 'b'},
+                 {'source': 'user', 'resource_id': 'a'},
+                 {'source': 'user', 'resource_id': 'a'},
+                 {'source': 'other', 'resource_id': 'b'}]
+        usage_by_resource = {}
+
+        with mock.patch.dict(web.config.main,
+                             {'trust_sources': ['openstack']}):
+            untrusted = web.filter_and_group(usage, usage_by_resource)
+
+        self.assertEquals(untrusted, {'user': 2, 'other': 1})
+        self.assertEquals(len(usage_by_resource['a']), 1)
+        self.assertEquals(len(usage_by_resource['b']), 1)
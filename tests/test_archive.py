@@ -0,0 +1,135 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from distil.archive import SampleArchive, RangeIndex
+from datetime import datetime, timedelta
+import unittest
+import tempfile
+import shutil
+import os
+
+t0 = datetime(2014, 1, 1)
+day = timedelta(days=1)
+
+
+class SampleArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _fill(self, archive, days):
+        for i in range(days):
+            archive.put('tenant', 'state', t0 + i * day, t0 + (i + 1) * day,
+                        [{'timestamp': (t0 + i * day).isoformat(),
+                          'counter_volume': i}])
+
+    def test_covered_range(self):
+        """A range inside an archived range is read back from it,
+           anything else is not archived."""
+        archive = SampleArchive(self.path, 1024)
+        self._fill(archive, 3)
+
+        samples = archive.get('tenant', 'state', t0 + day,
+                              t0 + day + timedelta(hours=1))
+        self.assertEqual(samples, [{'timestamp': (t0 + day).isoformat(),
+                                    'counter_volume': 1}])
+
+        self.assertEqual(archive.get('tenant', 'state', t0, t0 + 2 * day),
+                         None)
+        self.assertEqual(archive.get('tenant', 'volume.size', t0, t0 + day),
+                         None)
+
+    def test_segments_and_reload(self):
+        """Records roll over into new segments, and are found again
+           by a new archive on the same path."""
+        archive = SampleArchive(self.path, 1)
+        self._fill(archive, 3)
+        self.assertEqual(archive.segment, 2)
+
+        reloaded = SampleArchive(self.path, 1)
+        samples = reloaded.get('tenant', 'state', t0 + 2 * day, t0 + 3 * day)
+        self.assertEqual(samples[0]['counter_volume'], 2)
+
+    def test_partial_index_line(self):
+        """A partly written index line is ignored on reload."""
+        archive = SampleArchive(self.path, 1024)
+        self._fill(archive, 1)
+        with open(os.path.join(self.path, 'index'), 'a') as fh:
+            fh.write('{"tenant_id": "ten')
+
+        reloaded = SampleArchive(self.path, 1024)
+        self.assertNotEqual(reloaded.get('tenant', 'state', t0, t0 + day),
+                            None)
+
+        # and doesn't corrupt the next record written.
+        reloaded.put('tenant', 'state', t0 + day, t0 + 2 * day, [])
+        reloaded = SampleArchive(self.path, 1024)
+        self.assertEqual(reloaded.get('tenant', 'state', t0 + day,
+                                      t0 + 2 * day), [])
+
+    def test_variants(self):
+        """Samples are only read back for queries shaped the same as the
+           one that fetched them."""
+        archive = SampleArchive(self.path, 1024)
+        archive.put('tenant', 'state', t0, t0 + day, [], 'keys_a')
+
+        self.assertEqual(archive.get('tenant', 'state', t0, t0 + day,
+                                     'keys_a'), [])
+        self.assertEqual(archive.get('tenant', 'state', t0, t0 + day,
+                                     'keys_b'), None)
+        self.assertEqual(archive.get('tenant', 'state', t0, t0 + day),
+                         None)
+
+    def test_retention(self):
+        """Ranges past the retention are dropped, along with segments
+           holding nothing newer, and stay dropped on reload."""
+        archive = SampleArchive(self.path, 1)
+        self._fill(archive, 3)
+
+        now = t0 + 3 * day
+        archive.retention = timedelta(days=1, hours=12)
+        with archive.lock:
+            archive._expire(now)
+
+        self.assertEqual(archive.get('tenant', 'state', t0, t0 + day), None)
+        self.assertNotEqual(archive.get('tenant', 'state', t0 + day,
+                                        t0 + 2 * day), None)
+        self.assertFalse(os.path.exists(archive._segment_path(0)))
+
+        reloaded = SampleArchive(self.path, 1)
+        self.assertEqual(reloaded.get('tenant', 'state', t0, t0 + day), None)
+        self.assertNotEqual(reloaded.get('tenant', 'state', t0 + 2 * day,
+                                         t0 + 3 * day), None)
+
+    def test_range_index(self):
+        """Covering ranges are found among overlapping ones, and ranges
+           archived again replace the old copy."""
+        ranges = RangeIndex()
+        ranges.add((t0, t0 + 7 * day, 'week'))
+        for i in range(7):
+            ranges.add((t0 + i * day, t0 + (i + 1) * day, i))
+        ranges.add((t0 + day, t0 + 2 * day, 'again'))
+
+        self.assertEqual(len(ranges), 8)
+        self.assertEqual(ranges.find(t0 + day, t0 + 2 * day)[2], 'again')
+        self.assertEqual(ranges.find(t0 + day, t0 + 3 * day)[2], 'week')
+        self.assertEqual(ranges.find(t0 + 6 * day, t0 + 8 * day), None)
+
+        ranges.expire(t0 + 7 * day)
+        self.assertEqual(ranges.find(t0 + day, t0 + 3 * day)[2], 'week')
+        ranges.expire(t0 + 7 * day + timedelta(seconds=1))
+        self.assertEqual(len(ranges), 0)
@@ -13,8 +13,10 @@
 #    under the License.
 
 from . import test_interface, helpers
-from distil import database
-from datetime import timedelta
+from distil import database, models
+from distil.constants import dawn_of_time
+from datetime import datetime, timedelta
+import json
 
 
 class TestDatabaseModule(test_interface.TestInterface):
@@ -32,3 +34,157 @@ class TestDatabaseModule(test_interface.TestInterface):
             usage = db.usage(self.start, self.start + timedelta(days=60),
                              "tenant_id_" + str(i))
             self.assertEqual(usage.count(), num_resources)
+
+    def test_collection_start(self):
+        """The earliest start covers tenants we haven't inserted yet."""
+        db = database.Database(self.session)
+        tenant = db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        tenant.last_collected = dawn_of_time + timedelta(days=10)
+        self.session.commit()
+
+        self.assertEqual(db.collection_start(['tenant_a']),
+                         dawn_of_time + timedelta(days=10))
+        self.assertEqual(db.collection_start(['tenant_a', 'tenant_b']),
+                         dawn_of_time)
+        self.assertEqual(db.collection_start([]), None)
+        self.assertEqual(db.last_collected(['tenant_a', 'tenant_b']),
+                         {'tenant_a': dawn_of_time + timedelta(days=10),
+                          'tenant_b': dawn_of_time})
+
+    def test_leases(self):
+        """A lease is only held by one holder at a time, until it's
+           released or expires."""
+        db = database.Database(self.session)
+        minute = timedelta(minutes=1)
+
+        self.assertTrue(db.claim_lease('tenant:a', 'node_1', minute))
+        self.assertFalse(db.claim_lease('tenant:a', 'node_2', minute))
+        self.assertTrue(db.claim_lease('tenant:a', 'node_1', minute))
+        self.assertTrue(db.renew_lease('tenant:a', 'node_1', minute))
+        self.assertFalse(db.renew_lease('tenant:a', 'node_2', minute))
+
+        db.release_lease('tenant:a', 'node_2')
+        self.assertFalse(db.claim_lease('tenant:a', 'node_2', minute))
+        db.release_lease('tenant:a', 'node_1')
+        self.assertTrue(db.claim_lease('tenant:a', 'node_2', -minute))
+
+        # expired, so anyone may take it over.
+        self.assertTrue(db.claim_lease('tenant:a', 'node_1', minute))
+        self.assertFalse(db.renew_lease('tenant:a', 'node_2', minute))
+
+    def test_new_tenant_start(self):
+        """New tenants start from the beginning until there's been a
+           last run, then from wherever collection has got to, even when
+           the last run has fallen behind."""
+        db = database.Database(self.session)
+        end = datetime(2014, 1, 2)
+
+        # collecting the first of two new tenants leaves the second to
+        # start from the beginning.
+        tenant = db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        self.assertEqual(tenant.last_collected, dawn_of_time)
+        tenant.last_collected = end
+        self.session.flush()
+        tenant = db.insert_tenant('tenant_b', 'b', '', datetime.utcnow())
+        self.assertEqual(tenant.last_collected, dawn_of_time)
+
+        db.update_last_run(end - timedelta(days=1))
+        self.session.flush()
+        self.assertEqual(db._new_tenant_start(), end - timedelta(hours=1))
+
+        db.update_last_run(end)
+        self.session.flush()
+        self.assertEqual(self.session.query(models._Last_Run).count(), 1)
+
+    def test_sync_resource_metadata(self):
+        """Metadata is written from the latest entry once synced."""
+        db = database.Database(self.session)
+        db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        md_def = {'name': {'sources': ['display_name']}}
+
+        for name in ('first', 'second', 'third'):
+            db.insert_resource('tenant_a', 'res', 'Virtual Machine',
+                               datetime.utcnow(),
+                               {'resource_metadata': {'display_name': name}},
+                               md_def)
+
+        resource = self.session.query(models.Resource).one()
+        self.assertEqual(json.loads(resource.info)['name'], 'first')
+
+        db.sync_resource_metadata('tenant_a')
+        self.session.expire_all()
+        resource = self.session.query(models.Resource).one()
+        self.assertEqual(json.loads(resource.info),
+                         {'type': 'Virtual Machine', 'name': 'third'})
+
+    def test_discard_resources(self):
+        """Rolling back a batch only forgets what that batch added."""
+        db = database.Database(self.session)
+        db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        md_def = {'name': {'sources': ['display_name']}}
+
+        def insert(resource_id, name):
+            db.insert_resource('tenant_a', resource_id, 'Virtual Machine',
+                               datetime.utcnow(),
+                               {'resource_metadata': {'display_name': name}},
+                               md_def)
+
+        insert('res_1', 'kept')
+        db.keep_resources('tenant_a')
+        insert('res_1', 'discarded')
+        insert('res_2', 'discarded')
+        db.discard_resources('tenant_a')
+
+        self.assertEqual(db.known_resources['tenant_a'], set(['res_1']))
+        db.sync_resource_metadata('tenant_a')
+        self.session.expire_all()
+        resource = self.session.query(models.Resource).\
+            filter(models.Resource.id == 'res_1').one()
+        self.assertEqual(json.loads(resource.info)['name'], 'kept')
+
+    def test_carried_states(self):
+        """Carried states round trip, but only as of where they were
+           carried to."""
+        db = database.Database(self.session)
+        db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        as_of = dawn_of_time + timedelta(days=1)
+        states = {'state': {'res': {
+            'timestamp': as_of - timedelta(minutes=5),
+            'counter_volume': 1,
+            'resource_metadata': {'flavor.id': '1'}}}}
+
+        db.save_carried_states('tenant_a', states, as_of)
+        self.session.commit()
+
+        self.assertEqual(db.carried_states('tenant_a', as_of), states)
+        self.assertEqual(db.carried_states('tenant_a',
+                                           as_of + timedelta(hours=1)), {})
+
+    def test_bulk_insert(self):
+        """Bulk inserts are held back until flushed, resources first."""
+        db = database.BulkDatabase(self.session)
+        db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+        start = dawn_of_time
+
+        for i in range(3):
+            db.insert_resource('tenant_a', 'res_%s' % i, 'Volume',
+                               datetime.utcnow(), {'resource_metadata': {}},
+                               {})
+            db.insert_usage('tenant_a', 'res_%s' % i, {'b1.standard': 1},
+                            'gigabyte', start, start + timedelta(hours=1),
+                            datetime.utcnow())
+
+        self.assertEqual(self.session.query(models.UsageEntry).count(), 0)
+        db.flush()
+        self.assertEqual(self.session.query(models.Resource).count(), 3)
+        self.assertEqual(self.session.query(models.UsageEntry).count(), 3)
+
+    def test_open_windows(self):
+        db = database.Database(self.session)
+        db.insert_tenant('tenant_a', 'a', '', datetime.utcnow())
+
+        db.save_open_windows('tenant_a', {'image.size': dawn_of_time})
+        self.assertEqual(db.open_windows('tenant_a'),
+                         {'image.size': dawn_of_time})
+        db.save_open_windows('tenant_a', {})
+        self.assertEqual(db.open_windows('tenant_a'), {})
@@ -13,14 +13,20 @@
 #    under the License.
 
 import unittest
+import json
+import mock
+import requests
 from distil.models import Tenant as tenant_model
 from distil.models import UsageEntry, Resource, SalesOrder, _Last_Run
+from distil.models import CarriedState, OpenWindow, Lease
 from sqlalchemy.pool import NullPool
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from datetime import datetime, timedelta
+from distil import interface
+from distil.constants import date_format, other_date_format
 
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -54,9 +60,488 @@ class TestInterface(unittest.TestCase):
         self.session.query(UsageEntry).delete()
         self.session.query(Resource).delete()
         self.session.query(SalesOrder).delete()
+        self.session.query(CarriedState).delete()
+        self.session.query(OpenWindow).delete()
+        self.session.query(Lease).delete()
         self.session.query(tenant_model).delete()
         self.session.query(_Last_Run).delete()
         self.session.commit()
         self.session.close()
         self.contents = None
         self.resources = []
+
+
+class UsageSpanTests(unittest.TestCase):
+
+    def test_window_slices(self):
+        """Each window should get its own entries, and nothing
+           before the window start or at or after the window end."""
+        t0 = datetime(2014, 1, 1)
+        entries = [{'timestamp': t0 + timedelta(minutes=m)}
+                   for m in range(-30, 150, 10)]
+        span = interface.UsageSpan(entries)
+
+        window = span.window(t0, t0 + timedelta(hours=1))
+        self.assertEqual(window[0]['timestamp'], t0)
+        self.assertEqual(window[-1]['timestamp'], t0 + timedelta(minutes=50))
+
+        window = span.window(t0 + timedelta(hours=1), t0 + timedelta(hours=2))
+        self.assertEqual(len(window), 6)
+
+    def test_empty(self):
+        span = interface.UsageSpan([])
+        self.assertEqual(span.window(datetime(2014, 1, 1),
+                                     datetime(2014, 1, 2)), [])
+
+
+class FleetUsageTests(unittest.TestCase):
+
+    def test_single_fetch_partitioned(self):
+        """Tenants sharing a range should share the one fetch,
+           and each only see their own project's entries."""
+        t0 = datetime(2014, 1, 1)
+        conn = mock.Mock()
+        conn.usage.return_value = [
+            {'project_id': 'a', 'timestamp': t0},
+            {'project_id': 'b', 'timestamp': t0 + timedelta(minutes=5)},
+            {'project_id': 'a', 'timestamp': t0 + timedelta(minutes=10)},
+        ]
+        fleet = interface.FleetUsage()
+        end = t0 + timedelta(hours=1)
+
+        a = fleet.usage(conn, 'state', t0, end, 'a')
+        b = fleet.usage(conn, 'state', t0, end, 'b')
+        c = fleet.usage(conn, 'state', t0, end, 'c')
+
+        self.assertEqual(conn.usage.call_count, 1)
+        self.assertEqual([e['timestamp'] for e in a],
+                         [t0, t0 + timedelta(minutes=10)])
+        self.assertEqual(len(b), 1)
+        self.assertEqual(c, [])
+
+
+    def test_bounded_by_samples(self):
+        """Past max_samples, the least recently used ranges are dropped
+           and fetched again when needed."""
+        t0 = datetime(2014, 1, 1)
+        hour = timedelta(hours=1)
+        conn = mock.Mock()
+        conn.usage.side_effect = lambda meter_name, start, end: [
+            {'project_id': 'a', 'timestamp': start},
+            {'project_id': 'b', 'timestamp': start}]
+        fleet = interface.FleetUsage(max_samples=4)
+
+        for i in (0, 1, 0, 2):
+            fleet.usage(conn, 'state', t0 + i * hour, t0 + (i + 1) * hour,
+                        'a')
+        self.assertEqual(conn.usage.call_count, 3)
+        self.assertEqual(fleet.samples, 4)
+
+        # the second range was the least recently used.
+        fleet.usage(conn, 'state', t0 + hour, t0 + 2 * hour, 'a')
+        self.assertEqual(conn.usage.call_count, 4)
+
+
+class StreamingDecodeTests(unittest.TestCase):
+
+    def test_items_across_chunks(self):
+        """Items split at any point between chunks, even mid-character,
+           should decode the same as the whole body."""
+        samples = [{'resource_id': u'r%d' % i, 'counter_volume': i,
+                    'resource_metadata': {'name': u'caf\xe9 %d' % i}}
+                   for i in range(5)]
+        body = json.dumps(samples, indent=1, ensure_ascii=False).\
+            encode('utf-8')
+
+        for size in (1, 3, 64, len(body)):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(list(interface.iter_json_array(chunks)),
+                             samples)
+
+    def test_truncated(self):
+        chunks = ['[{"counter_volume": 1}, {"counter_vol']
+        self.assertRaises(interface.TruncatedResponse, list,
+                          interface.iter_json_array(chunks))
+
+    def test_scalars_across_chunks(self):
+        chunks = ['[1, 2', '3, tr', 'ue, "a\\\\', '"]']
+        self.assertEqual(list(interface.iter_json_array(chunks)),
+                         [1, 23, True, u'a\\'])
+
+    def test_malformed(self):
+        """A malformed item fails straight away, rather than being taken
+           for a truncated body, which would be retried."""
+        for chunks in (['[{"a": x}, 1]'], ['[{"a"', ': x}, 2]'],
+                       ['[1, 2x, 3]']):
+            try:
+                list(interface.iter_json_array(chunks))
+            except interface.TruncatedResponse:
+                self.fail('%s taken for truncated' % chunks)
+            except interface.InterfaceException:
+                pass
+            else:
+                self.fail('%s decoded' % chunks)
+
+
+class SortEntriesTests(unittest.TestCase):
+
+    def test_parse_timestamp(self):
+        """Both of ceilometer's timestamp formats should parse the same
+           as they do with strptime."""
+        for value, fmt in (('2014-03-18T23:51:05', date_format),
+                           ('2014-03-18T23:51:05.527721', other_date_format),
+                           ('2014-03-18T23:51:05.5', other_date_format)):
+            self.assertEqual(interface.parse_timestamp(value),
+                             datetime.strptime(value, fmt))
+
+    def test_newest_first(self):
+        stamps = ['2014-01-01T00:%02d:00' % m for m in range(0, 60, 10)]
+        entries = interface.sort_entries(
+            {'timestamp': t} for t in reversed(stamps))
+        self.assertEqual([e['timestamp'] for e in entries],
+                         [interface.parse_timestamp(t) for t in stamps])
+
+    def test_unordered_ties_stable(self):
+        """Out of order input, with ties, still gets a stable sort."""
+        stamps = ['2014-01-01T00:10:00', '2014-01-01T00:00:00',
+                  '2014-01-01T00:10:00', '2014-01-01T00:05:00']
+        entries = interface.sort_entries(
+            {'timestamp': t, 'i': i} for i, t in enumerate(stamps))
+        self.assertEqual([e['i'] for e in entries], [1, 3, 0, 2])
+
+
+class ProjectionTests(unittest.TestCase):
+
+    def test_projection(self):
+        """Only used fields and configured metadata keys are kept,
+           and repeated strings are shared."""
+        projection = interface.Projection(frozenset(['display_name',
+                                                     'flavor.id']))
+        samples = [{'counter_name': u'state', 'counter_volume': 1,
+                    'resource_id': u''.join([u'vm', u'1']),
+                    'project_id': u'tenant', 'source': u'openstack',
+                    'timestamp': u'2014-01-01T00:00:00',
+                    'message_id': u'abc', 'user_id': u'user',
+                    'resource_metadata': {'display_name': u'web',
+                                          'flavor.id': u'1',
+                                          'host': u'compute-1'}}
+                   for i in range(2)]
+
+        projected = [projection(s) for s in samples]
+
+        self.assertEqual(sorted(projected[0].keys()),
+                         ['counter_name', 'counter_volume', 'project_id',
+                          'resource_id', 'resource_metadata', 'source',
+                          'timestamp'])
+        self.assertEqual(projected[0]['resource_metadata'],
+                         {'display_name': u'web', 'flavor.id': u'1'})
+        self.assertTrue(projected[0]['resource_id'] is
+                        projected[1]['resource_id'])
+
+    def test_setup_projection(self):
+        """Keys come from the metadata definitions and transformers."""
+        self.addCleanup(setattr, interface, 'projection_keys',
+                        interface.projection_keys)
+        mappings = {
+            'state': {'transformer': 'Uptime',
+                      'metadata': {'name': {'sources': ['display_name']}}},
+            'volume.size': {'transformer': 'StorageMax', 'metadata': {}}}
+        with mock.patch.dict(interface.config.collection,
+                             {'meter_mappings': mappings}):
+            interface.setup_projection()
+        self.assertEqual(interface.projection_keys,
+                         frozenset(['display_name', 'flavor.id',
+                                    'instance_flavor_id', 'volume_type']))
+
+    def test_interned_bounded(self):
+        projection = interface.Projection(frozenset(), max_strings=10)
+        for i in range(100):
+            projection({'resource_id': u'vm%d' % i})
+        self.assertTrue(len(projection.strings) <= 10)
+
+
+class StatisticsSpanTests(unittest.TestCase):
+
+    def test_window(self):
+        t0 = datetime(2014, 1, 1)
+        t1 = t0 + timedelta(hours=1)
+        t2 = t1 + timedelta(hours=1)
+        span = interface.StatisticsSpan([
+            {'period_start': t0, 'groupby': {'resource_id': 'a'}},
+            {'period_start': t0, 'groupby': {'resource_id': 'b'}},
+            {'period_start': t1, 'groupby': {'resource_id': 'a'}}])
+
+        self.assertEqual(len(span.window(t0, t1)), 2)
+        self.assertEqual(len(span.window(t1, t2)), 1)
+        self.assertEqual(span.window(t2, t2 + timedelta(hours=1)), [])
+
+    def test_wide_window(self):
+        """Windows spanning several periods combine each resource's
+           statistics across them."""
+        t0 = datetime(2014, 1, 1)
+        t1 = t0 + timedelta(hours=1)
+        span = interface.StatisticsSpan([
+            {'period_start': t0, 'groupby': {'resource_id': 'a'},
+             'max': 2, 'min': 1, 'sum': 3, 'count': 2},
+            {'period_start': t1, 'groupby': {'resource_id': 'a'},
+             'max': 5, 'min': 5, 'sum': 5, 'count': 1},
+            {'period_start': t1, 'groupby': {'resource_id': 'b'},
+             'max': 1, 'min': 1, 'sum': 1, 'count': 1}])
+
+        window = span.window(t0, t0 + timedelta(hours=6))
+        self.assertEqual(len(window), 2)
+        a = window[0]
+        self.assertEqual((a['max'], a['min'], a['sum'], a['count']),
+                         (5, 1, 8, 3))
+
+
+class TransportTests(unittest.TestCase):
+
+    def _response(self, status, body):
+        r = mock.Mock()
+        r.status_code = status
+        r.text = body
+        r.iter_content.return_value = [body]
+        return r
+
+    def test_retry_then_succeed(self):
+        """Server errors and dropped connections are retried, and the
+           endpoint is only looked up once."""
+        transport = interface.Transport(mock.Mock())
+        transport.auth.get_ceilometer_endpoint.return_value = \
+            'http://localhost:8777/'
+        transport.session = mock.Mock()
+        transport.session.request.side_effect = [
+            requests.exceptions.ConnectionError('reset'),
+            self._response(503, 'busy'),
+            self._response(200, '[{"counter_volume": 1}]')]
+
+        with mock.patch('time.sleep'):
+            result = transport.get('/v2/meters/state', {'q': []})
+
+        self.assertEqual(result, [{'counter_volume': 1}])
+        self.assertEqual(transport.session.request.call_count, 3)
+        self.assertEqual(transport.auth.get_ceilometer_endpoint.call_count, 1)
+
+    def test_client_error_not_retried(self):
+        transport = interface.Transport(mock.Mock())
+        transport.session = mock.Mock()
+        transport.session.request.return_value = self._response(404, 'nope')
+
+        self.assertRaises(interface.InterfaceException, transport.get,
+                          '/v2/meters/state', {'q': []})
+        self.assertEqual(transport.session.request.call_count, 1)
+
+    def test_responses_closed(self):
+        """Responses are always closed, and the connection dropped when
+           the body is given up part way."""
+        transport = interface.Transport(mock.Mock())
+        transport.session = mock.Mock()
+        r = self._response(200, '[{"counter_volume": 1}]')
+        transport.session.request.return_value = r
+
+        transport.get('/v2/meters/state', {'q': []})
+        self.assertEqual(r.close.call_count, 1)
+        self.assertFalse(r.raw.close.called)
+
+        def too_large(items):
+            raise interface.ResponseTooLarge('too many')
+        self.assertRaises(interface.ResponseTooLarge, transport.get,
+                          '/v2/meters/state', {'q': []}, too_large)
+        self.assertEqual(r.close.call_count, 2)
+        self.assertEqual(r.raw.close.call_count, 1)
+
+    def test_gives_up(self):
+        transport = interface.Transport(mock.Mock())
+        transport.session = mock.Mock()
+        transport.session.request.return_value = self._response(500, 'broken')
+
+        with mock.patch('time.sleep'):
+            self.assertRaises(interface.InterfaceException, transport.get,
+                              '/v2/meters/state', {'q': []})
+        self.assertEqual(transport.session.request.call_count,
+                         transport.retries + 1)
+
+
+class ConcurrencyLimiterTests(unittest.TestCase):
+
+    def _request(self, limiter, latency=0.1, error=None):
+        slot = limiter.acquire()
+        slot.latency = latency
+        slot.release(error)
+        return slot
+
+    def test_slow_start(self):
+        """The limit grows by one per quick response up to the ceiling."""
+        limiter = interface.ConcurrencyLimiter(2, 6, latency_target=1.0)
+        for i in range(3):
+            self._request(limiter)
+        self.assertEqual(limiter.snapshot()['limit'], 5)
+        for i in range(3):
+            self._request(limiter)
+        self.assertEqual(limiter.snapshot()['limit'], 6)
+
+    def test_decrease(self):
+        """Overloads cut the limit, once for requests in flight together,
+           and not below the floor. Client errors leave it alone."""
+        limiter = interface.ConcurrencyLimiter(1, 16, latency_target=1.0)
+        for i in range(7):
+            self._request(limiter)
+        self.assertEqual(limiter.snapshot()['limit'], 8)
+
+        first = limiter.acquire()
+        second = limiter.acquire()
+        first.release(interface.RetryableError('503 busy'))
+        second.release(requests.exceptions.ReadTimeout('timed out'))
+        snapshot = limiter.snapshot()
+        self.assertEqual(snapshot['limit'], 4)
+        self.assertEqual(snapshot['in_flight'], 0)
+        self.assertEqual(snapshot['changes'][-1]['reason'], '503 busy')
+
+        self._request(limiter, latency=2.0)
+        self.assertEqual(limiter.snapshot()['limit'], 2)
+        self._request(limiter, error=interface.InterfaceException('404'))
+        self.assertEqual(limiter.snapshot()['limit'], 2)
+        self._request(limiter, latency=2.0)
+        self._request(limiter, latency=2.0)
+        self.assertEqual(limiter.snapshot()['limit'], 1)
+
+    def test_additive_increase(self):
+        """After a cut, the limit grows by one per limit's worth of quick
+           responses."""
+        limiter = interface.ConcurrencyLimiter(4, 16, latency_target=1.0)
+        self._request(limiter, error=interface.RetryableError('busy'))
+        self.assertEqual(limiter.snapshot()['limit'], 4)
+        for i in range(5):
+            self._request(limiter)
+        self.assertEqual(limiter.snapshot()['limit'], 5)
+
+    def test_transport_uses_limiter(self):
+        limiter = interface.ConcurrencyLimiter(4, 16, latency_target=60.0)
+        transport = interface.Transport(mock.Mock())
+        transport.session = mock.Mock()
+        r = mock.Mock()
+        r.status_code = 200
+        r.iter_content.return_value = ['[]']
+        transport.session.request.side_effect = [
+            requests.exceptions.ConnectionError('reset'), r]
+
+        with mock.patch('distil.interface.concurrency_limiter', limiter):
+            with mock.patch('time.sleep'):
+                transport.get('/v2/meters/state', {'q': []})
+
+        snapshot = limiter.snapshot()
+        self.assertEqual(snapshot['in_flight'], 0)
+        self.assertEqual(snapshot['limit'], 4)
+        self.assertEqual(snapshot['changes'], [])
+
+
+class SplitUsageTests(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('distil.interface.auth.Keystone'):
+            self.conn = interface.Interface()
+        self.start = datetime(2014, 1, 1)
+        self.end = self.start + timedelta(hours=1)
+        patcher = mock.patch.dict(interface.config.collection,
+                                  {'split': {'max_samples': 10,
+                                             'min_span_minutes': 15}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fields(self, fields):
+        values = dict((f['field'] + f['op'], f['value']) for f in fields)
+        return (interface.parse_timestamp(values['timestampge']),
+                interface.parse_timestamp(values['timestamplt']),
+                values.get('resource_ideq'))
+
+    def test_split_by_time(self):
+        """Too large responses are split in half until they fit,
+           and come back in order."""
+        def samples(meter_name, fields, bounded=False):
+            start, end, resource = self._fields(fields)
+            if end - start > timedelta(minutes=20):
+                raise interface.ResponseTooLarge()
+            return [{'timestamp': start}]
+
+        self.conn.samples = mock.Mock(side_effect=samples)
+        usage = self.conn.split_usage('state', self.start, self.end, 'ten')
+
+        self.assertEqual([u['timestamp'] for u in usage],
+                         [self.start + timedelta(minutes=m)
+                          for m in (0, 15, 30, 45)])
+
+    def test_split_by_resource(self):
+        """Once down to the minimum span, queries split by resource."""
+        def samples(meter_name, fields, bounded=False):
+            start, end, resource = self._fields(fields)
+            if resource is None:
+                raise interface.QueryTimeout()
+            return [{'timestamp': start + timedelta(minutes=ord(resource))}]
+
+        resources = [
+            {'resource_id': 'b', 'links': [{'rel': 'state'}]},
+            {'resource_id': 'a', 'links': [{'rel': 'state'}]},
+            {'resource_id': 'c', 'links': [{'rel': 'volume.size'}]}]
+
+        self.conn.samples = mock.Mock(side_effect=samples)
+        self.conn.resources = mock.Mock(return_value=resources)
+        end = self.start + timedelta(minutes=10)
+        usage = self.conn.split_usage('state', self.start, end, 'ten')
+
+        self.assertEqual([u['timestamp'] for u in usage],
+                         [self.start + timedelta(minutes=ord(r))
+                          for r in 'ab'])
+
+    def test_bound_items(self):
+        self.assertEqual(list(interface.bound_items(range(3), 3)), [0, 1, 2])
+        self.assertRaises(interface.ResponseTooLarge, list,
+                          interface.bound_items(range(4), 3))
+
+
+class ComplexQueryTests(unittest.TestCase):
+
+    def test_query_samples(self):
+        """Batched samples are renamed to match the meters api, and
+           split back up by meter, including meters with no samples."""
+        with mock.patch('distil.interface.auth.Keystone'):
+            conn = interface.Interface()
+        conn.projection = None
+        start = datetime(2014, 1, 1)
+        end = start + timedelta(hours=1)
+        samples = [
+            {'meter': 'state', 'volume': 1, 'metadata': {},
+             'timestamp': '2014-01-01T00:30:00'},
+            {'meter': 'volume.size', 'volume': 10, 'metadata': {},
+             'timestamp': '2014-01-01T00:10:00'}]
+
+        def post(path, body, consume, retry_timeouts=True):
+            self.assertEqual(path, '/v2/query/samples')
+            names = [e['=']['counter_name'] for e
+                     in json.loads(body['filter'])['and'][3]['or']]
+            self.assertEqual(names, ['state', 'volume.size', 'image'])
+            return consume(iter(samples))
+
+        conn.transport.post = mock.Mock(side_effect=post)
+        usage = conn.query_samples(['state', 'volume.size', 'image'],
+                                   start, end, 'ten')
+
+        self.assertEqual(usage['state'][0]['counter_volume'], 1)
+        self.assertEqual(usage['volume.size'][0]['counter_volume'], 10)
+        self.assertEqual(usage['image'], [])
+        self.assertEqual(conn.transport.post.call_count, 1)
+
+
+class ActiveMetersTests(unittest.TestCase):
+
+    def test_meters_by_project(self):
+        resources = [
+            {'project_id': 'a', 'links': [{'rel': 'self'},
+                                          {'rel': 'state'}]},
+            {'project_id': 'a', 'links': [{'rel': 'volume.size'}]},
+            {'project_id': 'b', 'links': [{'rel': 'ip.floating'}]}]
+        active = interface.ActiveMeters(resources)
+
+        self.assertEqual(active.meters('a'), set(['state', 'volume.size']))
+        self.assertEqual(active.meters('b'), set(['ip.floating']))
+        self.assertEqual(active.meters('idle'), set())
@@ -0,0 +1,51 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from distil.pipeline import Pipeline
+import threading
+import unittest
+import time
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_order(self):
+        """Items come out in order, through every stage."""
+        pipe = Pipeline(range(20), [('double', lambda x: [x, x]),
+                                    ('scale', lambda x: [x * 10])])
+        self.assertEqual(list(pipe),
+                         [x * 10 for x in range(20) for _ in range(2)])
+
+    def test_failure_raised(self):
+        """An exception in a stage is raised to the consumer."""
+        def stage(x):
+            if x == 3:
+                raise ValueError(x)
+            return [x]
+
+        pipe = Pipeline(range(10), [('stage', stage)])
+        self.assertRaises(ValueError, list, pipe)
+
+    def test_stop(self):
+        """Stopping early doesn't leave the stages blocked."""
+        threads = threading.active_count()
+        pipe = Pipeline(range(1000), [('stage', lambda x: [x])], depth=1)
+        for x in pipe:
+            if x == 2:
+                break
+        pipe.stop()
+
+        time.sleep(0.5)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(set(pipe.depths()), set(['stage']))
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from distil import scheduler
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import threading
+import heapq
+import unittest
+import mock
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def test_collection_end(self):
+        """Hours are only collected once settled."""
+        settle = timedelta(minutes=5)
+        self.assertEqual(scheduler.collection_end(datetime(2014, 1, 1, 3, 4),
+                                                  settle),
+                         datetime(2014, 1, 1, 2))
+        self.assertEqual(scheduler.collection_end(datetime(2014, 1, 1, 3, 5),
+                                                  settle),
+                         datetime(2014, 1, 1, 3))
+
+    def test_lag_queue(self):
+        """Most lagging first, then largest, and none that are current."""
+        end = datetime(2014, 1, 2)
+        last_collected = {'small': end - timedelta(hours=1),
+                          'large': end - timedelta(hours=1),
+                          'behind': end - timedelta(days=1),
+                          'current': end}
+        costs = {'large': 100, 'small': 2, 'behind': 1}
+
+        queue = scheduler.lag_queue(last_collected, costs, end)
+        order = [heapq.heappop(queue)[2] for _ in range(len(queue))]
+        self.assertEqual(order, ['behind', 'large', 'small'])
+
+    def test_run(self):
+        """The scheduler takes the run lock, collects the most lagging
+           tenants first, requeues those still behind, and records the
+           last run and gives up the lock once they've all caught up."""
+        end = datetime(2014, 1, 2)
+        hour = timedelta(hours=1)
+        collected = {'a': end - 3 * hour, 'b': end - hour}
+        costs = {'a': 1, 'b': 5}
+        turns = []
+        last_runs = []
+        locks = []
+        sched = None
+
+        class FakeDatabase(object):
+            def __init__(self, session):
+                pass
+
+            def last_collected(self, tenant_ids):
+                return dict((t, collected[t]) for t in tenant_ids)
+
+            def resource_counts(self):
+                return costs
+
+            def update_last_run(self, end):
+                last_runs.append(end)
+                sched.stop()
+
+        def collect(tenant, end, fleet, active, holder=None):
+            turns.append(tenant.id)
+            collected[tenant.id] += hour
+            return True, {"tenants": [], "errors": 0}
+
+        @contextmanager
+        def run_lock(db):
+            locks.append('lock')
+            yield True
+            locks.append('unlock')
+
+        tenants = [mock.Mock(id=tenant_id) for tenant_id in sorted(collected)]
+
+        with mock.patch('distil.scheduler.Interface') as Interface, \
+                mock.patch('distil.scheduler.collection_end',
+                           return_value=end), \
+                mock.patch('distil.scheduler.reset_cache'), \
+                mock.patch('distil.database.Database', FakeDatabase), \
+                mock.patch('distil.api.web.Session', mock.MagicMock()), \
+                mock.patch('distil.api.web.prepare_run'), \
+                mock.patch('distil.api.web.lease_holder',
+                           return_value=None), \
+                mock.patch('distil.api.web.run_lock', run_lock), \
+                mock.patch('distil.api.web.collect_tenant_usage', collect):
+            Interface.return_value.tenants = tenants
+            sched = scheduler.Scheduler(1, timedelta(minutes=5))
+            runner = threading.Thread(target=sched.run)
+            runner.start()
+            runner.join(10)
+            sched.stop()
+            runner.join()
+
+        # b is larger, so goes first among those as far behind.
+        self.assertEqual(turns, ['a', 'a', 'b', 'a'])
+        self.assertEqual(last_runs, [end])
+        self.assertEqual(locks, ['lock', 'unlock'])
@@ -0,0 +1,72 @@
+# Copyright (C) 2014 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from distil.transform_pool import TransformPool
+from distil.transformers import Uptime, GaugeMax
+from distil.constants import states
+from datetime import datetime, timedelta
+import unittest
+import random
+import mock
+
+t0 = datetime(2014, 1, 1)
+t1 = t0 + timedelta(hours=1)
+
+
+class TransformPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = TransformPool(2, 10)
+        patcher = mock.patch('distil.helpers.flavor_name')
+        flavor_name = patcher.start()
+        flavor_name.side_effect = lambda f: 'flavor-%s' % f
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _usage(self):
+        rand = random.Random(1)
+        usage = {}
+        for i in range(20):
+            timestamps = sorted(
+                t0 + timedelta(seconds=rand.randint(-600, 3700),
+                               microseconds=rand.randint(0, 999999))
+                for _ in range(rand.randint(0, 20)))
+            usage['resource_%s' % i] = [
+                {'timestamp': t,
+                 'counter_volume': rand.choice([states['active'],
+                                                states['stopped']]),
+                 'resource_metadata': rand.choice(
+                     [{'flavor.id': '1'}, {'instance_flavor_id': '2'}, {}])}
+                for t in timestamps]
+        return usage
+
+    def test_matches_in_process(self):
+        """Transforming in the pool gives the same usage as Uptime."""
+        usage = self._usage()
+        uptime = Uptime()
+
+        self.assertTrue(self.pool.handles(uptime, usage))
+        self.assertEqual(
+            self.pool.transform('state', usage, t0, t1),
+            dict((res, uptime.transform_usage('state', entries, t0, t1))
+                 for res, entries in usage.items()))
+
+    def test_handles(self):
+        """Only Uptime, and only with enough samples, goes to the pool."""
+        usage = self._usage()
+        self.assertFalse(self.pool.handles(GaugeMax(), usage))
+        self.assertFalse(self.pool.handles(
+            Uptime(), {'resource_0': usage['resource_0'][:1]}))
@@ -172,6 +172,39 @@ class UptimeTransformerTests(unittest.TestCase):
         self.assertEqual({testdata.flavor: 3600}, result)
 
 
+    def test_carry_over(self):
+        """
+        Test that the state carried over from a window is the last state
+        in it, and stands in for lead-in data in the next window.
+        """
+        xform = distil.transformers.Uptime()
+        state = [
+            {'timestamp': testdata.t0_10, 'counter_volume': states['active'],
+                'resource_metadata': {'instance_flavor_id': testdata.flavor}},
+            {'timestamp': testdata.t0_50, 'counter_volume': states['active'],
+                'resource_metadata': {'instance_flavor_id': testdata.flavor}},
+            {'timestamp': testdata.t1, 'counter_volume': states['stopped'],
+                'resource_metadata': {'instance_flavor_id': testdata.flavor}}
+        ]
+
+        carried = xform.carry_over(state, testdata.t0, testdata.t1)
+        self.assertEqual(carried, {
+            'timestamp': testdata.t0_50, 'counter_volume': states['active'],
+            'resource_metadata': {'flavor.id': testdata.flavor}})
+
+        hour = datetime.timedelta(hours=1)
+        with mock.patch('distil.helpers.flavor_name') as flavor_name:
+            flavor_name.side_effect = lambda x: x
+            result = xform.transform_usage(
+                'state', [carried] + [dict(s, timestamp=s['timestamp'] + hour)
+                                      for s in state],
+                testdata.t1, testdata.t1 + hour)
+        # the carried state covers the 10 minutes to the first sample.
+        self.assertEqual({testdata.flavor: 3600}, result)
+
+        self.assertEqual(xform.carry_over([], testdata.t0, testdata.t1), None)
+
+
 class GaugeMaxTransformerTests(unittest.TestCase):
 
     def test_all_different_values(self):
@@ -350,3 +383,54 @@ class GaugeNetworkServiceTransformerTests(unittest.TestCase):
                                           testdata.t1)
 
             self.assertEqual({'fake_meter': 1}, usage)
+
+
+class StatisticsTransformerTests(unittest.TestCase):
+    """
+    Transformers working from ceilometer statistics should agree with
+    their results from the equivalent samples.
+    """
+
+    stats = {'max': 25, 'min': 2, 'sum': 42, 'count': 7}
+
+    def test_gauge_max(self):
+        xform = distil.transformers.GaugeMax()
+        usage = xform.transform_statistics('some_meter', self.stats, None,
+                                           testdata.t0, testdata.t1)
+        self.assertEqual({'some_meter': 25}, usage)
+
+    def test_gauge_sum(self):
+        xform = distil.transformers.GaugeSum()
+        usage = xform.transform_statistics('fake_meter', self.stats, None,
+                                           testdata.t0, testdata.t1)
+        self.assertEqual({'fake_meter': 42}, usage)
+
+    def test_storage_max_volume_type(self):
+        entry = {'resource_metadata': {'volume_type': 'fast'}}
+        xform = distil.transformers.StorageMax()
+        with mock.patch('distil.helpers.volume_type') as volume_type:
+            volume_type.return_value = 'b1.fast'
+            usage = xform.transform_statistics('volume.size', self.stats,
+                                               entry, testdata.t0,
+                                               testdata.t1)
+        self.assertEqual({'b1.fast': 25}, usage)
+
+    def test_network_service(self):
+        xform = distil.transformers.GaugeNetworkService()
+        usage = xform.transform_statistics(
+            'fake_meter', {'max': 1, 'min': 0}, None,
+            testdata.t0, testdata.t1)
+        self.assertEqual({'fake_meter': 1}, usage)
+
+        usage = xform.transform_statistics(
+            'fake_meter', {'max': 2, 'min': 1}, None,
+            testdata.t0, testdata.t1)
+        self.assertEqual({'fake_meter': 1}, usage)
+
+    def test_network_service_ambiguous(self):
+        """With a 0 and a 2 we can't tell if there was also a 1."""
+        xform = distil.transformers.GaugeNetworkService()
+        self.assertRaises(distil.transformers.NeedsSamples,
+                          xform.transform_statistics, 'fake_meter',
+                          {'max': 2, 'min': 0}, None,
+                          testdata.t0, testdata.t1)